@@ -1,13 +1,20 @@
 ﻿import os
+import asyncio
 import json
+import math
+import sys
+import atexit
+import signal
 import time
-import numpy as np
+import queue
 import threading
-from datetime import datetime
 from collections import deque
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import numpy as np
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from opcua import Client
-from azure.iot.device import IoTHubDeviceClient, Message
+from azure.iot.device.aio import IoTHubDeviceClient
+from azure.iot.device import Message
 
 OPCUA_ENDPOINT = os.getenv("OPCUA_ENDPOINT", "opc.tcp://opcua-simulator:4840/freeopcua/server/")
 IOT_HUB_CONNECTION_STRING = os.getenv("IOT_HUB_CONNECTION_STRING", "")
@@ -15,6 +22,10 @@ DEVICE_ID = os.getenv("HOSTNAME", "unknown-device")
 DETECTION_INTERVAL = int(os.getenv("DETECTION_INTERVAL", "5"))
 WINDOW_SIZE = int(os.getenv("WINDOW_SIZE", "20"))
 ANOMALY_THRESHOLD = float(os.getenv("ANOMALY_THRESHOLD", "2.5"))
+ALERT_BATCH_INTERVAL = int(os.getenv("ALERT_BATCH_INTERVAL", "30"))
+SUBSCRIPTION_INTERVAL_MS = int(os.getenv("SUBSCRIPTION_INTERVAL_MS", "500"))
+HEARTBEAT_TIMEOUT = int(os.getenv("HEARTBEAT_TIMEOUT", "60"))
+MAX_PENDING_SENDS = int(os.getenv("MAX_PENDING_SENDS", "8"))
 HEALTH_PORT = 8080
 
 MONITORED_TAGS = [
@@ -23,16 +34,39 @@ MONITORED_TAGS = [
     ("ns=2;s=ProductionLine/Pressure", "Pressure"),
 ]
 
+try:
+    import orjson
+    _dumps = orjson.dumps
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+# Block-buffered stdout: flushed once per loop iteration, on ERROR, at exit and on SIGTERM
+_OUT = open(1, "wb", buffering=64 * 1024, closefd=False)
+atexit.register(_OUT.flush)
+
+def _handle_sigterm(signum, frame):
+    _OUT.flush()
+    sys.exit(0)
+
+signal.signal(signal.SIGTERM, _handle_sigterm)
+
 # --- Op Maturity: Structured Logging ---
-def log_json(level, message, component="AnomalyDetector", **kwargs):
+def utc_timestamp():
+    return datetime.utcnow().isoformat() + "Z"
+
+# Callers in the detection loop pass the tick's timestamp as ts instead of formatting a new one
+def log_json(level, message, component="AnomalyDetector", ts=None, **kwargs):
     entry = {
-        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "timestamp": ts or utc_timestamp(),
         "level": level,
         "component": component,
         "message": message,
         **kwargs
     }
-    print(json.dumps(entry), flush=True)
+    _OUT.write(_dumps(entry) + b"\n")
+    if level == "ERROR":
+        _OUT.flush()
 
 # --- Op Maturity: Health Server ---
 class HealthHandler(BaseHTTPRequestHandler):
@@ -50,40 +84,139 @@ class HealthHandler(BaseHTTPRequestHandler):
 
 def start_health_server():
     try:
-        server = HTTPServer(('0.0.0.0', HEALTH_PORT), HealthHandler)
+        server = ThreadingHTTPServer(('0.0.0.0', HEALTH_PORT), HealthHandler)
         log_json("INFO", f"Health server listening on port {HEALTH_PORT}", "HealthCheck")
         server.serve_forever()
     except Exception as e:
         log_json("ERROR", f"Failed to start health server: {e}", "HealthCheck")
 
+# Running mean/variance per tag (Welford, exponentially weighted once warmed up),
+# stored as one vector per statistic so all tags are scored in a single pass
 class AnomalyDetector:
-    def __init__(self, window_size=20, threshold=2.5):
+    __slots__ = ("tag_names", "window_size", "threshold", "alpha", "counts", "means", "vars")
+    
+    def __init__(self, tag_names, window_size=20, threshold=2.5):
+        self.tag_names = list(tag_names)
         self.window_size = window_size
         self.threshold = threshold
-        self.history = {}
+        self.alpha = 1.0 / window_size
+        self.counts = np.zeros(len(self.tag_names), dtype=np.int64)
+        self.means = np.zeros(len(self.tag_names))
+        self.vars = np.zeros(len(self.tag_names))
     
-    def add_sample(self, tag_name, value):
-        if tag_name not in self.history:
-            self.history[tag_name] = deque(maxlen=self.window_size)
-        
-        self.history[tag_name].append(value)
-        
-        if len(self.history[tag_name]) < self.window_size // 2:
-            return None, None, None
+    def add_samples(self, values):
+        """Update all tags with one sample each (NaN = no reading this cycle).
+
+        Returns (ready, anomalies, z_scores, baselines) arrays aligned with tag_names.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
         
-        values = np.array(self.history[tag_name])
-        mean = np.mean(values)
-        std = np.std(values)
+        self.counts += valid
+        # 1/n while warming up (exact Welford), then a fixed decay of 1/window_size
+        weight = np.where(valid, np.maximum(1.0 / np.maximum(self.counts, 1), self.alpha), 0.0)
+        delta = np.where(valid, values - self.means, 0.0)
+        self.means += weight * delta
+        self.vars = (1.0 - weight) * (self.vars + weight * delta * delta)
         
-        if std == 0:
-            return False, 0, mean
+        std = np.sqrt(self.vars)
+        with np.errstate(invalid="ignore"):
+            z_scores = np.where(std > 0, np.abs(values - self.means) / np.where(std > 0, std, 1.0), 0.0)
+        ready = valid & (self.counts >= self.window_size // 2)
+        anomalies = ready & (z_scores > self.threshold)
         
-        z_score = abs(value - mean) / std
-        is_anomaly = z_score > self.threshold
+        return ready, anomalies, z_scores, self.means.copy()
+    
+    def add_sample(self, tag_index, value):
+        """Update a single tag; returns (is_anomaly, z_score, baseline), all None while warming up."""
+        # Same weights as add_samples, applied to just this slot
+        value = float(value)
+        count = int(self.counts[tag_index]) + 1
+        self.counts[tag_index] = count
+        weight = max(1.0 / count, self.alpha)
+        mean = float(self.means[tag_index])
+        delta = value - mean
+        mean += weight * delta
+        var = (1.0 - weight) * (float(self.vars[tag_index]) + weight * delta * delta)
+        self.means[tag_index] = mean
+        self.vars[tag_index] = var
         
-        return is_anomaly, z_score, mean
+        if count < self.window_size // 2:
+            return None, None, None
+        std = math.sqrt(var)
+        z_score = abs(value - mean) / std if std > 0 else 0.0
+        return z_score > self.threshold, z_score, mean
 
-def main():
+def make_anomaly(tag_name, value, z_score, baseline, ts=None):
+    ts = ts or utc_timestamp()
+    log_json("WARNING", f"ANOMALY detected on {tag_name}", "Detector", ts=ts,
+             value=value, z_score=z_score)
+    return {
+        "timestamp": ts,
+        "tag": tag_name,
+        "value": round(value, 3),
+        "baseline": round(baseline, 3),
+        "deviation": round(z_score, 2),
+        "threshold": ANOMALY_THRESHOLD
+    }
+
+# Receives data-change pushes on the subscription thread and queues anomalies for the main loop
+class SubHandler:
+    def __init__(self, detector, nodes, alert_queue):
+        self.detector = detector
+        self.tag_index = {node.nodeid: i for i, (node, _) in enumerate(nodes)}
+        self.alert_queue = alert_queue
+        self.last_notification = time.monotonic()
+    
+    def datachange_notification(self, node, val, data):
+        self.last_notification = time.monotonic()
+        i = self.tag_index.get(node.nodeid)
+        if i is None:
+            return
+        tag_name = self.detector.tag_names[i]
+        try:
+            value = float(val)
+            is_anomaly, z_score, baseline = self.detector.add_sample(i, value)
+            if is_anomaly:
+                self.alert_queue.put(make_anomaly(tag_name, value, z_score, baseline))
+        except Exception as e:
+            log_json("ERROR", f"Error processing {tag_name}: {e}", "Detector")
+    
+    def status_change_notification(self, status):
+        log_json("WARNING", f"Subscription status changed: {status}", "OPCUA")
+
+def read_values(client, nodes):
+    # One Read service call for all tags; per-node reads only if the batch fails
+    try:
+        return np.array(client.get_values([node for node, _ in nodes]), dtype=np.float64)
+    except Exception as e:
+        log_json("WARNING", f"Batch read failed, falling back to per-node reads: {e}", "OPCUA")
+    
+    values = np.full(len(nodes), np.nan)
+    for i, (node, tag_name) in enumerate(nodes):
+        try:
+            values[i] = node.get_value()
+        except Exception as e:
+            log_json("ERROR", f"Error reading {tag_name}: {e}", "OPCUA")
+    return values
+
+async def send_alert(iot_client, alert):
+    try:
+        message = Message(_dumps(alert))
+        message.content_type = "application/json"
+        message.custom_properties["severity"] = alert["severity"]
+        await iot_client.send_message(message)
+        log_json("INFO", f"Alert sent to IoT Hub (severity: {alert['severity']})", "IoTHub",
+                 anomalies=alert["anomalyCount"])
+    except asyncio.CancelledError:
+        log_json("WARNING", "Alert dropped: too many sends in flight", "IoTHub",
+                 anomalies=alert["anomalyCount"])
+        raise
+    except Exception as e:
+        log_json("ERROR", f"Failed to send alert: {e}", "IoTHub")
+
+async def main():
+    loop = asyncio.get_running_loop()
     threading.Thread(target=start_health_server, daemon=True).start()
 
     log_json("INFO", f"Anomaly Detection starting for device: {DEVICE_ID}", "Detector")
@@ -92,13 +225,11 @@ def main():
     log_json("INFO", f"Window size: {WINDOW_SIZE} samples")
     log_json("INFO", f"Anomaly threshold: {ANOMALY_THRESHOLD} standard deviations")
     
-    detector = AnomalyDetector(window_size=WINDOW_SIZE, threshold=ANOMALY_THRESHOLD)
-    
     iot_client = None
     if IOT_HUB_CONNECTION_STRING:
         try:
             iot_client = IoTHubDeviceClient.create_from_connection_string(IOT_HUB_CONNECTION_STRING)
-            iot_client.connect()
+            await iot_client.connect()
             log_json("INFO", "Connected to Azure IoT Hub", "IoTHub")
         except Exception as e:
             log_json("WARNING", f"Failed to connect to IoT Hub: {e}", "IoTHub")
@@ -106,6 +237,9 @@ def main():
         log_json("WARNING", "No IoT Hub connection string. Alerts will be logged locally only.", "IoTHub")
     
     client = Client(OPCUA_ENDPOINT)
+    subscription = None
+    # Alert sends run as tasks so the next read never waits on IoT Hub; oldest is dropped past the cap
+    send_tasks = deque()
     
     try:
         client.connect()
@@ -120,74 +254,99 @@ def main():
             except Exception as e:
                 log_json("ERROR", f"Failed to get node {tag_name}: {e}", "OPCUA")
         
+        # Registered NodeIds let the server cache its node handles for repeated reads
+        opc_nodes = [node for node, _ in nodes]
+        try:
+            opc_nodes = client.register_nodes(opc_nodes)
+            nodes = [(node, tag_name) for node, (_, tag_name) in zip(opc_nodes, nodes)]
+        except Exception as e:
+            log_json("WARNING", f"Node registration failed, using plain NodeIds: {e}", "OPCUA")
+        
+        detector = AnomalyDetector([tag_name for _, tag_name in nodes],
+                                   window_size=WINDOW_SIZE, threshold=ANOMALY_THRESHOLD)
+        
+        # Server pushes value changes; polling is only used if the subscription cannot be created
+        alert_queue = queue.Queue()
+        handler = SubHandler(detector, nodes, alert_queue)
+        try:
+            subscription = client.create_subscription(SUBSCRIPTION_INTERVAL_MS, handler)
+            subscription.subscribe_data_change([node for node, _ in nodes])
+            log_json("INFO", f"Subscribed to {len(nodes)} tags ({SUBSCRIPTION_INTERVAL_MS} ms publishing interval)", "OPCUA")
+        except Exception as e:
+            subscription = None
+            log_json("WARNING", f"Subscription failed, falling back to polling: {e}", "OPCUA")
+        
         anomaly_count = 0
+        pending_anomalies = []
+        pending_severity = "warning"
+        last_alert = 0.0
         
         while True:
-            timestamp = datetime.utcnow().isoformat() + "Z"
+            timestamp = utc_timestamp()
             anomalies_detected = []
             
-            # log_json("INFO", "Checking for anomalies...", "Detector") # Noisy, maybe skip
+            if subscription is None:
+                values = await loop.run_in_executor(None, read_values, client, nodes)
+                _, anomalies, z_scores, baselines = detector.add_samples(values)
+                for i in np.flatnonzero(anomalies):
+                    anomalies_detected.append(make_anomaly(
+                        detector.tag_names[i], float(values[i]), float(z_scores[i]), float(baselines[i]),
+                        ts=timestamp))
+            else:
+                while not alert_queue.empty():
+                    anomalies_detected.append(alert_queue.get_nowait())
+                silence = time.monotonic() - handler.last_notification
+                if silence > HEARTBEAT_TIMEOUT:
+                    log_json("WARNING", f"No data changes received for {int(silence)} seconds", "OPCUA",
+                             ts=timestamp)
             
-            for node, tag_name in nodes:
-                try:
-                    value = node.get_value()
-                    is_anomaly, z_score, baseline = detector.add_sample(tag_name, value)
-                    
-                    if is_anomaly is None:
-                        # Collecting baseline, maybe debug log?
-                        pass
-                    elif is_anomaly:
-                        anomaly_count += 1
-                        anomaly_info = {
-                            "tag": tag_name,
-                            "value": round(value, 3),
-                            "baseline": round(baseline, 3),
-                            "deviation": round(z_score, 2),
-                            "threshold": ANOMALY_THRESHOLD
-                        }
-                        anomalies_detected.append(anomaly_info)
-                        log_json("WARNING", f"ANOMALY detected on {tag_name}", "Detector", 
-                                 value=value, z_score=z_score)
-                    else:
-                        # Normal
-                        pass
-                        
-                except Exception as e:
-                    log_json("ERROR", f"Error reading {tag_name}: {e}", "OPCUA")
+            anomaly_count += len(anomalies_detected)
             
             if anomalies_detected and iot_client:
-                try:
-                    alert = {
-                        "messageType": "anomalyAlert",
-                        "deviceId": DEVICE_ID,
-                        "timestamp": timestamp,
-                        "anomalyCount": len(anomalies_detected),
-                        "totalAnomalies": anomaly_count,
-                        "anomalies": anomalies_detected,
-                        "severity": "warning" if len(anomalies_detected) < 2 else "critical"
-                    }
-                    message = Message(json.dumps(alert))
-                    message.content_type = "application/json"
-                    message.custom_properties["severity"] = alert["severity"]
-                    iot_client.send_message(message)
-                    log_json("INFO", f"Alert sent to IoT Hub (severity: {alert['severity']})", "IoTHub")
-                except Exception as e:
-                    log_json("ERROR", f"Failed to send alert: {e}", "IoTHub")
+                pending_anomalies.extend(anomalies_detected)
+                if len(anomalies_detected) >= 2:
+                    pending_severity = "critical"
+            
+            # Warnings from consecutive cycles share one message; critical cycles go out immediately
+            if pending_anomalies and (pending_severity == "critical"
+                                      or time.monotonic() - last_alert >= ALERT_BATCH_INTERVAL):
+                alert = {
+                    "messageType": "anomalyAlert",
+                    "deviceId": DEVICE_ID,
+                    "timestamp": timestamp,
+                    "anomalyCount": len(pending_anomalies),
+                    "totalAnomalies": anomaly_count,
+                    "anomalies": pending_anomalies,
+                    "severity": pending_severity
+                }
+                send_tasks = deque(task for task in send_tasks if not task.done())
+                if len(send_tasks) >= MAX_PENDING_SENDS:
+                    send_tasks.popleft().cancel()
+                send_tasks.append(asyncio.create_task(send_alert(iot_client, alert)))
+                pending_anomalies = []
+                pending_severity = "warning"
+                last_alert = time.monotonic()
             
-            time.sleep(DETECTION_INTERVAL)
+            _OUT.flush()
+            await asyncio.sleep(DETECTION_INTERVAL)
             
     except Exception as e:
         log_json("ERROR", f"Fatal Error: {e}", "System")
     finally:
         try:
+            if subscription is not None:
+                subscription.delete()
             client.disconnect()
         except:
             pass
         if iot_client:
             try:
-                iot_client.disconnect()
+                pending_sends = [task for task in send_tasks if not task.done()]
+                if pending_sends:
+                    await asyncio.wait(pending_sends, timeout=5)
+                await iot_client.disconnect()
             except:
                 pass
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -12,12 +12,15 @@ This is their high-volume revenue driver.
 """
 
 import asyncio
+import base64
 import json
+import sys
+import atexit
+import signal
 import os
-import random
-import threading
+import time
+import numpy as np
 from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
 from azure.iot.device.aio import IoTHubDeviceClient
 from azure.iot.device import Message
 
@@ -26,44 +29,93 @@ IOT_HUB_CONNECTION_STRING = os.getenv("IOT_HUB_CONNECTION_STRING", "")
 PUBLISH_INTERVAL = float(os.getenv("PUBLISH_INTERVAL", "0.5"))  # 2Hz default
 DEVICE_ID = os.getenv("DEVICE_ID", "ev-battery-lab-01")
 NUM_CELLS = int(os.getenv("NUM_CELLS", "96"))
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "10"))  # Telemetry samples per IoT Hub message
+BATCH_MAX_AGE = float(os.getenv("BATCH_MAX_AGE", "2.0"))  # Seconds before a partial batch is sent
+CELL_ENCODING = os.getenv("CELL_ENCODING", "uint16")  # uint16 (fixed-point, base64) or float
 HEALTH_PORT = 8080
+HEALTH_REQUEST_TIMEOUT = 5.0  # Seconds a health client has to send its request
+
+# Fixed-point cell voltage encoding: V = CELL_Q_OFFSET + q * CELL_Q_STEP
+CELL_Q_OFFSET = 2.8
+CELL_Q_STEP = 1e-4
+
+try:
+    import orjson
+    _dumps = orjson.dumps
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+# Block-buffered stdout: flushed once per loop iteration, on ERROR, at exit and on SIGTERM
+_OUT = open(1, "wb", buffering=64 * 1024, closefd=False)
+atexit.register(_OUT.flush)
+
+def _handle_sigterm(signum, frame):
+    _OUT.flush()
+    sys.exit(0)
+
+signal.signal(signal.SIGTERM, _handle_sigterm)
 
 # --- Op Maturity: Structured Logging ---
-def log_json(level, message, component="EVBatterySimulator", **kwargs):
+def utc_timestamp():
+    return datetime.utcnow().isoformat() + "Z"
+
+# The publish loop passes its per-tick timestamp as ts instead of formatting a new one
+def log_json(level, message, component="EVBatterySimulator", ts=None, **kwargs):
     entry = {
-        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "timestamp": ts or utc_timestamp(),
         "level": level,
         "component": component,
         "message": message,
         **kwargs
     }
-    print(json.dumps(entry), flush=True)
+    _OUT.write(_dumps(entry) + b"\n")
+    if level == "ERROR":
+        _OUT.flush()
 
 # --- Op Maturity: Health Server ---
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        if self.path == '/health':
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(b"OK")
-        else:
-            self.send_response(404)
-            self.end_headers()
+# Served from the main event loop, so no extra thread competes with the publish loop
+HEALTH_OK = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nOK"
+HEALTH_NOT_FOUND = b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
 
-    def log_message(self, format, *args):
-        # Suppress default HTTP logging to keep stdout clean
+async def handle_health(reader, writer):
+    try:
+        # Bounded so a client that connects and never sends a request can't hold the handler open
+        async with asyncio.timeout(HEALTH_REQUEST_TIMEOUT):
+            request_line = await reader.readline()
+            # Drain the headers so closing the socket doesn't reset the connection
+            line = request_line
+            while line not in (b"\r\n", b"\n", b""):
+                line = await reader.readline()
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1] == b"/health":
+                writer.write(HEALTH_OK)
+            else:
+                writer.write(HEALTH_NOT_FOUND)
+            await writer.drain()
+    except Exception:
         pass
+    finally:
+        writer.close()
 
-def start_health_server():
+async def start_health_server():
     try:
-        server = HTTPServer(('0.0.0.0', HEALTH_PORT), HealthHandler)
+        server = await asyncio.start_server(handle_health, '0.0.0.0', HEALTH_PORT)
         log_json("INFO", f"Health server listening on port {HEALTH_PORT}", "HealthCheck")
-        server.serve_forever()
+        return server
     except Exception as e:
         log_json("ERROR", f"Failed to start health server: {e}", "HealthCheck")
+        return None
+
+# PCG64 generator; fills whole arrays per call instead of one draw per cell
+_RNG = np.random.default_rng()
 
 # Simulation state
 class BatteryPackState:
+    __slots__ = ("num_cells", "state_of_charge", "pack_voltage", "pack_current", "pack_temp",
+                 "cycle_count", "cell_voltages", "cell_noise", "discharge_rate", "test_phase",
+                 "phase_timer")
+    
     def __init__(self, num_cells: int):
         self.num_cells = num_cells
         self.state_of_charge = 100.0  # Starts full
@@ -73,10 +125,8 @@ class BatteryPackState:
         self.cycle_count = 0
         
         # Cell voltages - slight variance around nominal
-        self.cell_voltages = [
-            3.7 + random.uniform(-0.05, 0.05) 
-            for _ in range(num_cells)
-        ]
+        self.cell_voltages = _RNG.uniform(3.65, 3.75, size=num_cells)
+        self.cell_noise = np.empty(num_cells)
         
         # Discharge rate (% per second at full load)
         self.discharge_rate = 0.02
@@ -134,23 +184,25 @@ class BatteryPackState:
         cell_voltage_base = 3.0 + (self.state_of_charge / 100.0) * 1.2
         
         # Update individual cell voltages with realistic variance
-        for i in range(self.num_cells):
-            # Each cell drifts slightly
-            drift = random.gauss(0, 0.002)
-            self.cell_voltages[i] = cell_voltage_base + drift
-            # Clamp to realistic range
-            self.cell_voltages[i] = max(2.8, min(4.25, self.cell_voltages[i]))
+        # (each cell drifts slightly, clamped to realistic range), in place in the preallocated buffers
+        noise = self.cell_noise
+        _RNG.standard_normal(out=noise)
+        noise *= 0.002
+        noise += cell_voltage_base
+        np.clip(noise, 2.8, 4.25, out=self.cell_voltages)
         
         # Pack voltage is sum of cells
-        self.pack_voltage = sum(self.cell_voltages)
+        self.pack_voltage = float(self.cell_voltages.sum())
         
         # Temperature bounds
         self.pack_temp = max(20.0, min(45.0, self.pack_temp))
         
-    def to_telemetry(self) -> dict:
-        """Generate telemetry message"""
-        telemetry = {
-            "timestamp": datetime.utcnow().isoformat() + "Z",
+    def to_summary(self, timestamp: str = None) -> dict:
+        """Generate pack-level telemetry (no per-cell data)"""
+        cell_min = float(self.cell_voltages.min())
+        cell_max = float(self.cell_voltages.max())
+        return {
+            "timestamp": timestamp or utc_timestamp(),
             "deviceId": DEVICE_ID,
             "dataType": "ev_battery",
             "pack": {
@@ -159,34 +211,53 @@ class BatteryPackState:
                 "stateOfCharge": round(self.state_of_charge, 1),
                 "temperature": round(self.pack_temp, 1),
                 "testPhase": self.test_phase,
-                "cycleCount": self.cycle_count
-            },
-            "cells": {}
+                "cycleCount": self.cycle_count,
+                # Derived metrics
+                "cellMin": round(cell_min, 4),
+                "cellMax": round(cell_max, 4),
+                "cellDelta": round(cell_max - cell_min, 4)
+            }
         }
         
-        # Add individual cell voltages
-        for i, voltage in enumerate(self.cell_voltages):
-            telemetry["cells"][f"cell_{i+1:02d}"] = round(voltage, 4)
-            
-        # Add derived metrics
-        telemetry["pack"]["cellMin"] = round(min(self.cell_voltages), 4)
-        telemetry["pack"]["cellMax"] = round(max(self.cell_voltages), 4)
-        telemetry["pack"]["cellDelta"] = round(
-            max(self.cell_voltages) - min(self.cell_voltages), 4
-        )
+    def to_full_telemetry(self, timestamp: str = None) -> dict:
+        """Generate telemetry message including individual cell voltages"""
+        telemetry = self.to_summary(timestamp)
+        
+        # Individual cell voltages, ordered cell 1..N
+        if CELL_ENCODING == "uint16":
+            q = np.clip(np.round((self.cell_voltages - CELL_Q_OFFSET) / CELL_Q_STEP), 0, 65535).astype("<u2")
+            telemetry["cells_q"] = base64.b64encode(q.tobytes()).decode("ascii")
+            telemetry["cells_scale"] = {"offset": CELL_Q_OFFSET, "step": CELL_Q_STEP}
+        else:
+            telemetry["cells"] = np.round(self.cell_voltages, 4).tolist()
         
         return telemetry
 
 
+async def send_batch(iot_client, batch):
+    """Send buffered telemetry as one IoT Hub message.
+
+    The device SDK has no multi-message send, so several samples are packed
+    into a single JSON array payload. A batch of one keeps the plain object format.
+    """
+    payload = batch[0] if len(batch) == 1 else batch
+    message = Message(_dumps(payload))
+    message.content_type = "application/json"
+    message.content_encoding = "utf-8"
+    message.custom_properties["dataType"] = "ev_battery"
+    message.custom_properties["batchSize"] = str(len(batch))
+    await iot_client.send_message(message)
+
+
 async def main():
     # Start Health Server
-    health_thread = threading.Thread(target=start_health_server, daemon=True)
-    health_thread.start()
+    health_server = await start_health_server()
 
     log_json("INFO", "EV Battery Pack Simulator Starting")
     log_json("INFO", f"Device ID: {DEVICE_ID}")
     log_json("INFO", f"Number of cells: {NUM_CELLS}")
     log_json("INFO", f"Publish interval: {PUBLISH_INTERVAL}s ({1/PUBLISH_INTERVAL:.1f} Hz)")
+    log_json("INFO", f"Batch size: {BATCH_SIZE} samples (max age {BATCH_MAX_AGE}s)")
     
     # Initialize battery state
     battery = BatteryPackState(NUM_CELLS)
@@ -209,15 +280,22 @@ async def main():
     
     log_json("INFO", "Starting simulation loop", "Simulator")
     
+    pending = []
+    last_flush = time.monotonic()
+    
     try:
         message_count = 0
         while True:
             # Update battery state
             battery.update(PUBLISH_INTERVAL)
             
-            # Generate telemetry
-            telemetry = battery.to_telemetry()
+            # Generate telemetry (summary only when the log line is its sole consumer)
+            tick_ts = utc_timestamp()
             message_count += 1
+            if iot_client:
+                telemetry = battery.to_full_telemetry(tick_ts)
+            elif message_count % 10 == 0:
+                telemetry = battery.to_summary(tick_ts)
             
             # Log summary (not full payload - too large)
             if message_count % 10 == 0:  # Log every 10th message
@@ -225,27 +303,35 @@ async def main():
                        f"{telemetry['pack']['current']:.1f}A, "
                        f"SoC: {telemetry['pack']['stateOfCharge']:.1f}%, "
                        f"Phase: {telemetry['pack']['testPhase']}")
-                log_json("INFO", msg, "Telemetry")
+                log_json("INFO", msg, "Telemetry", ts=tick_ts)
             
-            # Send to IoT Hub
+            # Send to IoT Hub in batches
             if iot_client:
-                try:
-                    message = Message(json.dumps(telemetry))
-                    message.content_type = "application/json"
-                    message.content_encoding = "utf-8"
-                    message.custom_properties["dataType"] = "ev_battery"
-                    await iot_client.send_message(message)
-                except Exception as e:
-                    log_json("ERROR", f"Send failed: {e}", "IoTHub")
+                pending.append(telemetry)
+                if len(pending) >= BATCH_SIZE or time.monotonic() - last_flush >= BATCH_MAX_AGE:
+                    try:
+                        await send_batch(iot_client, pending)
+                    except Exception as e:
+                        log_json("ERROR", f"Send failed: {e}", "IoTHub", ts=tick_ts, batch_size=len(pending))
+                    pending = []
+                    last_flush = time.monotonic()
             
+            _OUT.flush()
             await asyncio.sleep(PUBLISH_INTERVAL)
             
     except KeyboardInterrupt:
         log_json("INFO", "Shutting down...", "System")
     finally:
         if iot_client:
+            if pending:
+                try:
+                    await send_batch(iot_client, pending)
+                except Exception as e:
+                    log_json("ERROR", f"Final flush failed: {e}", "IoTHub")
             await iot_client.disconnect()
             log_json("INFO", "Disconnected from IoT Hub", "IoTHub")
+        if health_server:
+            health_server.close()
 
 
 if __name__ == "__main__":
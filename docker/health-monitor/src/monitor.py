@@ -1,20 +1,30 @@
 ﻿import os
+import asyncio
 import time
 import socket
 import psutil
 import json
+import sys
+import atexit
+import signal
 import hashlib
 import hmac
 import base64
+import gzip
 import threading
 from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 DEVICE_ID = os.getenv("HOSTNAME", socket.gethostname())
 CUSTOMER_ID = os.getenv("CUSTOMER_ID", "dmc-internal")
 LOG_ANALYTICS_WORKSPACE_ID = os.getenv("LOG_ANALYTICS_WORKSPACE_ID", "")
 LOG_ANALYTICS_KEY = os.getenv("LOG_ANALYTICS_KEY", "")
+# Decoded once at startup instead of on every upload
+_DECODED_KEY = base64.b64decode(LOG_ANALYTICS_KEY) if LOG_ANALYTICS_KEY else None
+LOG_ANALYTICS_GZIP = os.getenv("LOG_ANALYTICS_GZIP", "true").lower() == "true"
 COLLECTION_INTERVAL = int(os.getenv("COLLECTION_INTERVAL", "60"))
 HEALTH_PORT = 8080
 
@@ -22,6 +32,32 @@ NETWORK_ENDPOINTS = [
     ("opcua-simulator", 4840),
 ]
 
+# Keep the TLS connection to the ingestion endpoint warm across uploads
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=2,
+    pool_maxsize=4,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=["POST"])
+))
+
+try:
+    import orjson
+    _dumps = orjson.dumps
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+# Block-buffered stdout: flushed once per loop iteration, on ERROR, at exit and on SIGTERM
+_OUT = open(1, "wb", buffering=64 * 1024, closefd=False)
+atexit.register(_OUT.flush)
+
+def _handle_sigterm(signum, frame):
+    _OUT.flush()
+    sys.exit(0)
+
+signal.signal(signal.SIGTERM, _handle_sigterm)
+
 # --- Op Maturity: Structured Logging ---
 def log_json(level, message, component="HealthMonitor", **kwargs):
     entry = {
@@ -31,7 +67,9 @@ def log_json(level, message, component="HealthMonitor", **kwargs):
         "message": message,
         **kwargs
     }
-    print(json.dumps(entry), flush=True)
+    _OUT.write(_dumps(entry) + b"\n")
+    if level == "ERROR":
+        _OUT.flush()
 
 # --- Op Maturity: Health Server ---
 class HealthHandler(BaseHTTPRequestHandler):
@@ -49,14 +87,20 @@ class HealthHandler(BaseHTTPRequestHandler):
 
 def start_health_server():
     try:
-        server = HTTPServer(('0.0.0.0', HEALTH_PORT), HealthHandler)
+        server = ThreadingHTTPServer(('0.0.0.0', HEALTH_PORT), HealthHandler)
         log_json("INFO", f"Health server listening on port {HEALTH_PORT}", "HealthCheck")
         server.serve_forever()
     except Exception as e:
         log_json("ERROR", f"Failed to start health server: {e}", "HealthCheck")
 
+# Values that never change for the life of the process
+_BOOT_TIME_ISO = datetime.fromtimestamp(psutil.boot_time()).isoformat()
+_MEM_TOTAL_GB = round(psutil.virtual_memory().total / (1024**3), 2)
+# Prime the CPU counters so the non-blocking reading below is measured since import
+psutil.cpu_percent(interval=None)
+
 def collect_system_metrics():
-    cpu_percent = psutil.cpu_percent(interval=1)
+    cpu_percent = psutil.cpu_percent(interval=None)
     memory = psutil.virtual_memory()
     disk = psutil.disk_usage('/')
     
@@ -64,39 +108,51 @@ def collect_system_metrics():
         "cpu_percent": cpu_percent,
         "memory_percent": memory.percent,
         "memory_used_gb": round(memory.used / (1024**3), 2),
-        "memory_total_gb": round(memory.total / (1024**3), 2),
+        "memory_total_gb": _MEM_TOTAL_GB,
         "disk_percent": disk.percent,
         "disk_used_gb": round(disk.used / (1024**3), 2),
         "disk_total_gb": round(disk.total / (1024**3), 2),
-        "boot_time": datetime.fromtimestamp(psutil.boot_time()).isoformat()
+        "boot_time": _BOOT_TIME_ISO
     }
 
+async def _probe(host, port):
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=2)
+        writer.close()
+        await writer.wait_closed()
+        return "reachable"
+    except socket.gaierror as e:
+        return f"error: {str(e)}"
+    except (OSError, asyncio.TimeoutError):
+        return "unreachable"
+    except Exception as e:
+        return f"error: {str(e)}"
+
+async def _probe_all():
+    return await asyncio.gather(*[_probe(host, port) for host, port in NETWORK_ENDPOINTS])
+
+# Probes run concurrently, so a cycle costs max(probe) rather than sum(probe)
+_PROBE_LOOP = asyncio.new_event_loop()
+
 def check_network_endpoints():
-    results = {}
-    for host, port in NETWORK_ENDPOINTS:
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(5)
-            result = sock.connect_ex((host, port))
-            results[f"{host}:{port}"] = "reachable" if result == 0 else "unreachable"
-            sock.close()
-        except Exception as e:
-            results[f"{host}:{port}"] = f"error: {str(e)}"
-    return results
+    statuses = _PROBE_LOOP.run_until_complete(_probe_all())
+    return {f"{host}:{port}": status for (host, port), status in zip(NETWORK_ENDPOINTS, statuses)}
 
 def send_to_log_analytics(data):
     if not LOG_ANALYTICS_WORKSPACE_ID or not LOG_ANALYTICS_KEY:
         log_json("WARNING", "Log Analytics not configured, skipping upload", "LogAnalytics")
         return False
     
-    body = json.dumps(data)
+    body = _dumps(data)
+    if LOG_ANALYTICS_GZIP:
+        # Signature covers the bytes actually sent, so sign the compressed length
+        body = gzip.compress(body, compresslevel=1)
     content_length = len(body)
     rfc1123date = datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')
     
-    string_to_hash = f"POST\n{content_length}\napplication/json\nx-ms-date:{rfc1123date}\n/api/logs"
-    bytes_to_hash = string_to_hash.encode('utf-8')
-    decoded_key = base64.b64decode(LOG_ANALYTICS_KEY)
-    encoded_hash = base64.b64encode(hmac.new(decoded_key, bytes_to_hash, digestmod=hashlib.sha256).digest()).decode('utf-8')
+    bytes_to_hash = (b"POST\n" + str(content_length).encode() + b"\napplication/json\nx-ms-date:"
+                     + rfc1123date.encode() + b"\n/api/logs")
+    encoded_hash = base64.b64encode(hmac.new(_DECODED_KEY, bytes_to_hash, digestmod=hashlib.sha256).digest()).decode('utf-8')
     authorization = f"SharedKey {LOG_ANALYTICS_WORKSPACE_ID}:{encoded_hash}"
     
     uri = f"https://{LOG_ANALYTICS_WORKSPACE_ID}.ods.opinsights.azure.com/api/logs?api-version=2016-04-01"
@@ -107,9 +163,11 @@ def send_to_log_analytics(data):
         'Log-Type': 'IPCHealthMonitor',
         'x-ms-date': rfc1123date
     }
+    if LOG_ANALYTICS_GZIP:
+        headers['Content-Encoding'] = 'gzip'
     
     try:
-        response = requests.post(uri, data=body, headers=headers)
+        response = _SESSION.post(uri, data=body, headers=headers, timeout=(5, 15))
         return response.status_code >= 200 and response.status_code <= 299
     except Exception as e:
         log_json("ERROR", f"Log Analytics upload failed: {e}", "LogAnalytics")
@@ -158,6 +216,7 @@ def main():
         if send_to_log_analytics(health_record):
             log_json("INFO", "Sent to Log Analytics", "LogAnalytics")
         
+        _OUT.flush()
         time.sleep(COLLECTION_INTERVAL)
 
 if __name__ == "__main__":
@@ -1,20 +1,31 @@
 ﻿import os
 import json
+import sys
+import atexit
+import signal
 import time
 import hashlib
 import hmac
 import base64
+import gzip
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import threading
 from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import random
 
 DEVICE_ID = os.getenv("HOSTNAME", "unknown-device")
 CUSTOMER_ID = os.getenv("CUSTOMER_ID", "dmc-internal")
 LOG_ANALYTICS_WORKSPACE_ID = os.getenv("LOG_ANALYTICS_WORKSPACE_ID", "")
 LOG_ANALYTICS_KEY = os.getenv("LOG_ANALYTICS_KEY", "")
+# Decoded once at startup instead of on every upload
+_DECODED_KEY = base64.b64decode(LOG_ANALYTICS_KEY) if LOG_ANALYTICS_KEY else None
+LOG_ANALYTICS_GZIP = os.getenv("LOG_ANALYTICS_GZIP", "true").lower() == "true"
 FORWARD_INTERVAL = int(os.getenv("FORWARD_INTERVAL", "30"))
+EVENT_INTERVAL = float(os.getenv("EVENT_INTERVAL", "1"))
+MAX_BATCH_BYTES = int(os.getenv("MAX_BATCH_BYTES", str(200 * 1024)))
 HEALTH_PORT = 8080
 
 DEMO_EVENTS = [
@@ -27,6 +38,32 @@ DEMO_EVENTS = [
     {"EventID": 4738, "EventType": "AccountChange", "Description": "A user account was changed"},
 ]
 
+# Keep the TLS connection to the ingestion endpoint warm across uploads
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=2,
+    pool_maxsize=4,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=["POST"])
+))
+
+try:
+    import orjson
+    _dumps = orjson.dumps
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+# Block-buffered stdout: flushed once per loop iteration, on ERROR, at exit and on SIGTERM
+_OUT = open(1, "wb", buffering=64 * 1024, closefd=False)
+atexit.register(_OUT.flush)
+
+def _handle_sigterm(signum, frame):
+    _OUT.flush()
+    sys.exit(0)
+
+signal.signal(signal.SIGTERM, _handle_sigterm)
+
 # --- Op Maturity: Structured Logging ---
 def log_json(level, message, component="LogForwarder", **kwargs):
     entry = {
@@ -36,7 +73,9 @@ def log_json(level, message, component="LogForwarder", **kwargs):
         "message": message,
         **kwargs
     }
-    print(json.dumps(entry), flush=True)
+    _OUT.write(_dumps(entry) + b"\n")
+    if level == "ERROR":
+        _OUT.flush()
 
 # --- Op Maturity: Health Server ---
 class HealthHandler(BaseHTTPRequestHandler):
@@ -54,45 +93,57 @@ class HealthHandler(BaseHTTPRequestHandler):
 
 def start_health_server():
     try:
-        server = HTTPServer(('0.0.0.0', HEALTH_PORT), HealthHandler)
+        server = ThreadingHTTPServer(('0.0.0.0', HEALTH_PORT), HealthHandler)
         log_json("INFO", f"Health server listening on port {HEALTH_PORT}", "HealthCheck")
         server.serve_forever()
     except Exception as e:
         log_json("ERROR", f"Failed to start health server: {e}", "HealthCheck")
 
-def generate_simulated_event():
-    event_template = random.choice(DEMO_EVENTS)
+def generate_simulated_events(count):
+    # Draw every random field for the whole burst up front, one call per field
+    templates = random.choices(DEMO_EVENTS, k=count)
+    roles = random.choices(["operator", "admin"], weights=[0.7, 0.3], k=count)
+    account_ids = random.choices(range(1, 6), k=count)
+    logon_types = random.choices([2, 3, 10], k=count)
+    ip_octets = random.choices(range(1, 255), k=count)
+    time_generated = datetime.utcnow().isoformat() + "Z"
     
-    return {
-        "TimeGenerated": datetime.utcnow().isoformat() + "Z",
-        "EventID": event_template["EventID"],
-        "EventType": event_template["EventType"],
-        "Description": event_template["Description"],
-        "Computer": DEVICE_ID,
-        "CustomerId": CUSTOMER_ID,
-        "SourceSystem": "WindowsSecurityEvent",
-        "Channel": "Security",
-        "Account": f"DMC\\{'operator' if random.random() > 0.3 else 'admin'}{random.randint(1,5)}",
-        "LogonType": random.choice([2, 3, 10]) if "Logon" in event_template["EventType"] else None,
-        "IpAddress": f"192.168.1.{random.randint(1, 254)}",
-        "ComplianceFramework": ["NIST-800-171", "CMMC-L2"],
-        "RetentionDays": 90
-    }
+    return [
+        {
+            "TimeGenerated": time_generated,
+            "EventID": event_template["EventID"],
+            "EventType": event_template["EventType"],
+            "Description": event_template["Description"],
+            "Computer": DEVICE_ID,
+            "CustomerId": CUSTOMER_ID,
+            "SourceSystem": "WindowsSecurityEvent",
+            "Channel": "Security",
+            "Account": f"DMC\\{role}{account_id}",
+            "LogonType": logon_type if "Logon" in event_template["EventType"] else None,
+            "IpAddress": f"192.168.1.{ip_octet}",
+            "ComplianceFramework": ["NIST-800-171", "CMMC-L2"],
+            "RetentionDays": 90
+        }
+        for event_template, role, account_id, logon_type, ip_octet
+        in zip(templates, roles, account_ids, logon_types, ip_octets)
+    ]
 
 def send_to_log_analytics(events):
     if not LOG_ANALYTICS_WORKSPACE_ID or not LOG_ANALYTICS_KEY:
         log_json("WARNING", "Log Analytics not configured", "LogAnalytics")
         return False
     
-    body = json.dumps(events)
+    body = _dumps(events)
+    if LOG_ANALYTICS_GZIP:
+        # Signature covers the bytes actually sent, so sign the compressed length
+        body = gzip.compress(body, compresslevel=1)
     content_length = len(body)
     rfc1123date = datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')
     
-    string_to_hash = f"POST\n{content_length}\napplication/json\nx-ms-date:{rfc1123date}\n/api/logs"
-    bytes_to_hash = string_to_hash.encode('utf-8')
-    decoded_key = base64.b64decode(LOG_ANALYTICS_KEY)
+    bytes_to_hash = (b"POST\n" + str(content_length).encode() + b"\napplication/json\nx-ms-date:"
+                     + rfc1123date.encode() + b"\n/api/logs")
     encoded_hash = base64.b64encode(
-        hmac.new(decoded_key, bytes_to_hash, digestmod=hashlib.sha256).digest()
+        hmac.new(_DECODED_KEY, bytes_to_hash, digestmod=hashlib.sha256).digest()
     ).decode('utf-8')
     authorization = f"SharedKey {LOG_ANALYTICS_WORKSPACE_ID}:{encoded_hash}"
     
@@ -105,9 +156,11 @@ def send_to_log_analytics(events):
         'x-ms-date': rfc1123date,
         'time-generated-field': 'TimeGenerated'
     }
+    if LOG_ANALYTICS_GZIP:
+        headers['Content-Encoding'] = 'gzip'
     
     try:
-        response = requests.post(uri, data=body, headers=headers)
+        response = _SESSION.post(uri, data=body, headers=headers, timeout=(5, 15))
         return response.status_code >= 200 and response.status_code <= 299
     except Exception as e:
         log_json("ERROR", f"Upload failed: {e}", "LogAnalytics")
@@ -119,25 +172,37 @@ def main():
     log_json("INFO", f"Compliance Log Forwarder starting for device: {DEVICE_ID}")
     log_json("INFO", f"Customer: {CUSTOMER_ID}")
     log_json("INFO", f"Forward interval: {FORWARD_INTERVAL} seconds")
+    log_json("INFO", f"Event interval: {EVENT_INTERVAL} seconds")
     
     event_count = 0
+    pending = []
+    pending_bytes = 0
+    last_flush = time.monotonic()
     
     while True:
         batch_size = random.randint(1, 5)
-        events = [generate_simulated_event() for _ in range(batch_size)]
-        event_count += batch_size
-        
-        log_json("INFO", f"Forwarding {batch_size} security events...", "Forwarder")
-        
-        for event in events:
+        for event in generate_simulated_events(batch_size):
+            pending.append(event)
+            pending_bytes += len(_dumps(event))
             log_json("INFO", f"Event {event['EventID']}: {event['EventType']}", "Audit", account=event['Account'])
         
-        if send_to_log_analytics(events):
-            log_json("INFO", f"Forwarded to Log Analytics (total: {event_count})", "LogAnalytics")
-        else:
-            log_json("INFO", "Events logged locally (Log Analytics not configured)", "LocalLog")
+        # One POST per FORWARD_INTERVAL (or per MAX_BATCH_BYTES) instead of one per tick
+        if pending_bytes >= MAX_BATCH_BYTES or time.monotonic() - last_flush >= FORWARD_INTERVAL:
+            event_count += len(pending)
+            log_json("INFO", f"Forwarding {len(pending)} security events...", "Forwarder",
+                     batch_bytes=pending_bytes)
+            
+            if send_to_log_analytics(pending):
+                log_json("INFO", f"Forwarded to Log Analytics (total: {event_count})", "LogAnalytics")
+            else:
+                log_json("INFO", "Events logged locally (Log Analytics not configured)", "LocalLog")
+            
+            pending = []
+            pending_bytes = 0
+            last_flush = time.monotonic()
         
-        time.sleep(FORWARD_INTERVAL)
+        _OUT.flush()
+        time.sleep(EVENT_INTERVAL)
 
 if __name__ == "__main__":
     main()
@@ -12,50 +12,112 @@ import asyncio
 import json
 import random
 import math
-import threading
-from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import sys
+import atexit
+import signal
+import time
+from datetime import datetime, timezone
 from asyncua import Server, ua
 
+# libuv-based event loop when available; stock asyncio otherwise
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 OPCUA_PORT = 4841
 HEALTH_PORT = 8080
+HEALTH_REQUEST_TIMEOUT = 5.0  # Seconds a health client has to send its request
 UPDATE_INTERVAL = 0.1  # 10Hz
 
+try:
+    import orjson
+    _dumps = orjson.dumps
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+# Block-buffered stdout: flushed once per loop iteration, on ERROR, at exit and on SIGTERM
+_OUT = open(1, "wb", buffering=64 * 1024, closefd=False)
+atexit.register(_OUT.flush)
+
+def _handle_sigterm(signum, frame):
+    _OUT.flush()
+    sys.exit(0)
+
+signal.signal(signal.SIGTERM, _handle_sigterm)
+
 # --- Op Maturity: Structured Logging ---
+# Formatted date/time of the current second, reused until the second rolls over
+_TS_CACHE = [None, ""]
+
+def utc_timestamp():
+    seconds, nanos = divmod(time.time_ns(), 1_000_000_000)
+    if seconds != _TS_CACHE[0]:
+        _TS_CACHE[0] = seconds
+        _TS_CACHE[1] = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds))
+    return f"{_TS_CACHE[1]}.{nanos // 1000:06d}Z"
+
 def log_json(level, message, component="MotionSimulator", **kwargs):
     entry = {
-        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "timestamp": utc_timestamp(),
         "level": level,
         "component": component,
         "message": message,
         **kwargs
     }
-    print(json.dumps(entry), flush=True)
+    _OUT.write(_dumps(entry) + b"\n")
+    if level == "ERROR":
+        _OUT.flush()
 
 # --- Op Maturity: Health Server ---
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        if self.path == '/health':
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(b"OK")
-        else:
-            self.send_response(404)
-            self.end_headers()
+# Served from the main event loop, so no extra thread competes with the update loop
+HEALTH_OK = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nOK"
+HEALTH_NOT_FOUND = b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
 
-    def log_message(self, format, *args):
+async def handle_health(reader, writer):
+    try:
+        # Bounded so a client that connects and never sends a request can't hold the handler open
+        async with asyncio.timeout(HEALTH_REQUEST_TIMEOUT):
+            request_line = await reader.readline()
+            # Drain the headers so closing the socket doesn't reset the connection
+            line = request_line
+            while line not in (b"\r\n", b"\n", b""):
+                line = await reader.readline()
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1] == b"/health":
+                writer.write(HEALTH_OK)
+            else:
+                writer.write(HEALTH_NOT_FOUND)
+            await writer.drain()
+    except Exception:
         pass
+    finally:
+        writer.close()
 
-def start_health_server():
+async def start_health_server():
     try:
-        server = HTTPServer(('0.0.0.0', HEALTH_PORT), HealthHandler)
+        server = await asyncio.start_server(handle_health, '0.0.0.0', HEALTH_PORT)
         log_json("INFO", f"Health server listening on port {HEALTH_PORT}", "HealthCheck")
-        server.serve_forever()
+        return server
     except Exception as e:
         log_json("ERROR", f"Failed to start health server: {e}", "HealthCheck")
+        return None
+
+
+# Motion pattern constants
+CIRCLE_RADIUS = 100.0
+CIRCLE_SPEED = 0.5
+PICK_PLACE_CYCLE = 4.0
 
 
 class GantrySimulator:
+    __slots__ = (
+        "x_pos", "y_pos", "z_pos", "x_vel", "y_vel", "z_vel",
+        "motor_temp", "ambient_temp", "fan_on", "fan_threshold_high", "fan_threshold_low",
+        "pattern_phase", "motion_mode", "cycle_count", "in_motion", "alarm_active", "servo_enabled",
+    )
+    
     def __init__(self):
         self.x_pos = 0.0
         self.y_pos = 0.0
@@ -76,77 +138,104 @@ class GantrySimulator:
         self.servo_enabled = True
         
     def update(self, dt: float):
-        self.pattern_phase += dt
+        # Runs at 10 Hz: module functions and attributes are read into locals once per call
+        sin = math.sin
+        gauss = random.gauss
+        uniform = random.uniform
         
-        if self.motion_mode == "CIRCLE":
-            radius = 100.0
-            speed = 0.5
-            self.x_pos = radius * math.cos(self.pattern_phase * speed)
-            self.y_pos = radius * math.sin(self.pattern_phase * speed)
-            self.z_pos = 50.0 + 20.0 * math.sin(self.pattern_phase * speed * 2)
+        pattern_phase = self.pattern_phase + dt
+        self.pattern_phase = pattern_phase
+        motion_mode = self.motion_mode
+        x, y, z = self.x_pos, self.y_pos, self.z_pos
+        
+        if motion_mode == "CIRCLE":
+            a = pattern_phase * CIRCLE_SPEED
+            x = CIRCLE_RADIUS * math.cos(a)
+            y = CIRCLE_RADIUS * sin(a)
+            z = 50.0 + 20.0 * sin(2.0 * a)
             self.in_motion = True
             
-        elif self.motion_mode == "PICK_PLACE":
-            cycle_time = 4.0
-            phase = (self.pattern_phase % cycle_time) / cycle_time
+        elif motion_mode == "PICK_PLACE":
+            phase = (pattern_phase % PICK_PLACE_CYCLE) / PICK_PLACE_CYCLE
             
             if phase < 0.25:
-                self.x_pos = 0.0
-                self.y_pos = 0.0
-                self.z_pos = 100.0 - (phase * 4 * 80)
+                x = 0.0
+                y = 0.0
+                z = 100.0 - (phase * 4 * 80)
             elif phase < 0.5:
                 progress = (phase - 0.25) * 4
-                self.x_pos = 150.0 * progress
-                self.y_pos = 75.0 * progress
-                self.z_pos = 20.0 + 30.0 * math.sin(progress * math.pi)
+                x = 150.0 * progress
+                y = 75.0 * progress
+                z = 20.0 + 30.0 * sin(progress * math.pi)
             elif phase < 0.75:
-                self.x_pos = 150.0
-                self.y_pos = 75.0
-                self.z_pos = 50.0 - ((phase - 0.5) * 4 * 30)
+                x = 150.0
+                y = 75.0
+                z = 50.0 - ((phase - 0.5) * 4 * 30)
             else:
                 progress = (phase - 0.75) * 4
-                self.x_pos = 150.0 * (1 - progress)
-                self.y_pos = 75.0 * (1 - progress)
-                self.z_pos = 20.0 + 80.0 * progress
+                x = 150.0 * (1 - progress)
+                y = 75.0 * (1 - progress)
+                z = 20.0 + 80.0 * progress
             
             self.in_motion = True
-            if phase < 0.1 and self.pattern_phase > 1:
+            if phase < 0.1 and pattern_phase > 1:
                 self.cycle_count += 1
         
         # Add noise
-        self.x_pos += random.gauss(0, 0.01)
-        self.y_pos += random.gauss(0, 0.01)
-        self.z_pos += random.gauss(0, 0.005)
+        self.x_pos = x + gauss(0, 0.01)
+        self.y_pos = y + gauss(0, 0.01)
+        self.z_pos = z + gauss(0, 0.005)
         
-        self.x_vel = random.uniform(100, 200) if self.in_motion else 0
-        self.y_vel = random.uniform(100, 200) if self.in_motion else 0
-        self.z_vel = random.uniform(50, 100) if self.in_motion else 0
+        in_motion = self.in_motion
+        self.x_vel = uniform(100, 200) if in_motion else 0
+        self.y_vel = uniform(100, 200) if in_motion else 0
+        self.z_vel = uniform(50, 100) if in_motion else 0
         
         # Temperature simulation
-        if self.in_motion:
-            self.motor_temp += 0.02 * dt
+        motor_temp = self.motor_temp
+        if in_motion:
+            motor_temp += 0.02 * dt
         
-        cooling_rate = 0.05 if self.fan_on else 0.01
-        self.motor_temp -= cooling_rate * (self.motor_temp - self.ambient_temp) * dt
+        fan_on = self.fan_on
+        cooling_rate = 0.05 if fan_on else 0.01
+        motor_temp -= cooling_rate * (motor_temp - self.ambient_temp) * dt
+        self.motor_temp = motor_temp
         
         # Fan control with hysteresis
-        if self.motor_temp > self.fan_threshold_high and not self.fan_on:
+        if motor_temp > self.fan_threshold_high and not fan_on:
             self.fan_on = True
-            log_json("INFO", f"Fan ON - Temp: {self.motor_temp:.1f}°C", "Thermal")
-        elif self.motor_temp < self.fan_threshold_low and self.fan_on:
+            log_json("INFO", f"Fan ON - Temp: {motor_temp:.1f}°C", "Thermal")
+        elif motor_temp < self.fan_threshold_low and fan_on:
             self.fan_on = False
-            log_json("INFO", f"Fan OFF - Temp: {self.motor_temp:.1f}°C", "Thermal")
+            log_json("INFO", f"Fan OFF - Temp: {motor_temp:.1f}°C", "Thermal")
         
-        if self.motor_temp > 55.0 and not self.alarm_active:
-            self.alarm_active = True
-            log_json("WARNING", f"Overtemperature! {self.motor_temp:.1f}°C", "Alarm")
-        elif self.motor_temp <= 55.0:
+        if motor_temp > 55.0:
+            if not self.alarm_active:
+                self.alarm_active = True
+                log_json("WARNING", f"Overtemperature! {motor_temp:.1f}°C", "Alarm")
+        else:
             self.alarm_active = False
 
 
+async def write_values(server, nodes, values):
+    # One Write service call on the server's internal session instead of an await per variable
+    now = datetime.now(timezone.utc)
+    params = ua.WriteParameters()
+    params.NodesToWrite = [
+        ua.WriteValue(
+            NodeId=node.nodeid,
+            AttributeId=ua.AttributeIds.Value,
+            Value=ua.DataValue(ua.Variant(value), SourceTimestamp=now),
+        )
+        for node, value in zip(nodes, values)
+    ]
+    for result in await server.iserver.isession.write(params):
+        result.check()
+
+
 async def main():
     # Start Health Server
-    threading.Thread(target=start_health_server, daemon=True).start()
+    health_server = await start_health_server()
 
     log_json("INFO", "Motion/Gantry OPC-UA Simulator Starting")
     log_json("INFO", f"OPC-UA Port: {OPCUA_PORT}")
@@ -180,9 +269,11 @@ async def main():
     cycle_count = await gantry.add_variable(idx, "Cycle_Count", 0)
     motion_mode = await gantry.add_variable(idx, "Motion_Mode", "CIRCLE")
     
-    for var in [x_pos, y_pos, z_pos, x_vel, y_vel, z_vel, motor_temp, 
-                fan_status, servo_enabled, in_motion, alarm_active, 
-                cycle_count, motion_mode]:
+    # Write order used by write_values() every tick
+    variables = [x_pos, y_pos, z_pos, x_vel, y_vel, z_vel, motor_temp, 
+                 fan_status, servo_enabled, in_motion, alarm_active, 
+                 cycle_count, motion_mode]
+    for var in variables:
         await var.set_writable()
     
     log_json("INFO", f"OPC-UA Server started at {endpoint}", "OPCUA")
@@ -195,9 +286,15 @@ async def main():
     mode_duration = 30
     
     async with server:
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        # Bound once; the loop below runs at 10 Hz
+        update = gantry_sim.update
+        loop_time = loop.time
+        sleep = asyncio.sleep
         try:
             while True:
-                gantry_sim.update(UPDATE_INTERVAL)
+                update(UPDATE_INTERVAL)
                 
                 mode_timer += UPDATE_INTERVAL
                 if mode_timer >= mode_duration:
@@ -207,25 +304,41 @@ async def main():
                     gantry_sim.pattern_phase = 0
                     log_json("INFO", f"Switching to {gantry_sim.motion_mode}", "Mode")
                 
-                await x_pos.write_value(round(gantry_sim.x_pos, 3))
-                await y_pos.write_value(round(gantry_sim.y_pos, 3))
-                await z_pos.write_value(round(gantry_sim.z_pos, 3))
-                await x_vel.write_value(round(gantry_sim.x_vel, 1))
-                await y_vel.write_value(round(gantry_sim.y_vel, 1))
-                await z_vel.write_value(round(gantry_sim.z_vel, 1))
-                await motor_temp.write_value(round(gantry_sim.motor_temp, 1))
-                await fan_status.write_value(gantry_sim.fan_on)
-                await servo_enabled.write_value(gantry_sim.servo_enabled)
-                await in_motion.write_value(gantry_sim.in_motion)
-                await alarm_active.write_value(gantry_sim.alarm_active)
-                await cycle_count.write_value(gantry_sim.cycle_count)
-                await motion_mode.write_value(gantry_sim.motion_mode)
+                await write_values(server, variables, [
+                    round(gantry_sim.x_pos, 3),
+                    round(gantry_sim.y_pos, 3),
+                    round(gantry_sim.z_pos, 3),
+                    round(gantry_sim.x_vel, 1),
+                    round(gantry_sim.y_vel, 1),
+                    round(gantry_sim.z_vel, 1),
+                    round(gantry_sim.motor_temp, 1),
+                    gantry_sim.fan_on,
+                    gantry_sim.servo_enabled,
+                    gantry_sim.in_motion,
+                    gantry_sim.alarm_active,
+                    gantry_sim.cycle_count,
+                    gantry_sim.motion_mode,
+                ])
                 
-                await asyncio.sleep(UPDATE_INTERVAL)
+                # Sleep until the next deadline so the time spent in the cycle doesn't stretch the interval
+                next_tick += UPDATE_INTERVAL
+                delay = next_tick - loop_time()
+                if delay < 0:
+                    # Overran the deadline: resync instead of bursting to catch up
+                    next_tick = loop_time()
+                    delay = 0
+                _OUT.flush()
+                await sleep(delay)
                 
         except KeyboardInterrupt:
             log_json("INFO", "Shutting down...", "System")
+        finally:
+            if health_server:
+                health_server.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
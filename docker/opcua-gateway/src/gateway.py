@@ -1,17 +1,41 @@
 ﻿import asyncio
 import json
 import os
-import threading
-from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from asyncua import Client
+import sys
+import atexit
+import signal
+import time
+from asyncua import Client, ua
 from azure.iot.device.aio import IoTHubDeviceClient
 from azure.iot.device import Message
 
+# libuv-based event loop when available; stock asyncio otherwise
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    import zstandard
+    _ZSTD = zstandard.ZstdCompressor(level=3)
+except ImportError:
+    _ZSTD = None
+
 OPCUA_ENDPOINT = os.getenv("OPCUA_ENDPOINT", "opc.tcp://opcua-simulator:4840/freeopcua/server/")
 IOT_HUB_CONNECTION_STRING = os.getenv("IOT_HUB_CONNECTION_STRING", "")
+IOT_HUB_KEEP_ALIVE = int(os.getenv("IOT_HUB_KEEP_ALIVE", "60"))  # MQTT keep-alive seconds
+DEVICE_ID = os.getenv("DEVICE_ID", os.getenv("HOSTNAME", "unknown"))
 PUBLISH_INTERVAL = int(os.getenv("PUBLISH_INTERVAL", "5"))
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "6"))  # Telemetry samples per IoT Hub message
+BATCH_MAX_AGE = float(os.getenv("BATCH_MAX_AGE", "30.0"))  # Seconds before a partial batch is sent
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", "500"))  # Samples buffered for sending before the oldest are dropped
+SUBSCRIPTION_INTERVAL_MS = int(os.getenv("SUBSCRIPTION_INTERVAL_MS", "500"))
+# Longest wait, in seconds, before retrying a polled tag that keeps failing to read
+POLL_RETRY_MAX = 60.0
+# Consumers must zstd-decompress bodies sent with contentEncoding "zstd"
+TELEMETRY_ZSTD = os.getenv("TELEMETRY_ZSTD", "false").lower() == "true"
 HEALTH_PORT = 8080
+HEALTH_REQUEST_TIMEOUT = 5.0  # Seconds a health client has to send its request
 
 TAGS = [
     "ns=2;s=ProductionLine/CycleCount",
@@ -23,99 +47,315 @@ TAGS = [
     "ns=2;s=ProductionLine/MachineState",
 ]
 
+try:
+    import orjson
+    _dumps = orjson.dumps
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+# Block-buffered stdout: flushed once per loop iteration, on ERROR, at exit and on SIGTERM
+_OUT = open(1, "wb", buffering=64 * 1024, closefd=False)
+atexit.register(_OUT.flush)
+
+def _handle_sigterm(signum, frame):
+    _OUT.flush()
+    sys.exit(0)
+
+signal.signal(signal.SIGTERM, _handle_sigterm)
+
 # --- Op Maturity: Structured Logging ---
-def log_json(level, message, component="OPCUAGateway", **kwargs):
+# Formatted date/time of the current second, reused until the second rolls over
+_TS_CACHE = [None, ""]
+
+def utc_timestamp():
+    seconds, nanos = divmod(time.time_ns(), 1_000_000_000)
+    if seconds != _TS_CACHE[0]:
+        _TS_CACHE[0] = seconds
+        _TS_CACHE[1] = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds))
+    return f"{_TS_CACHE[1]}.{nanos // 1000:06d}Z"
+
+# The publish loop passes its per-cycle timestamp as ts instead of formatting a new one
+def log_json(level, message, component="OPCUAGateway", ts=None, **kwargs):
     entry = {
-        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "timestamp": ts or utc_timestamp(),
         "level": level,
         "component": component,
         "message": message,
         **kwargs
     }
-    print(json.dumps(entry), flush=True)
+    _OUT.write(_dumps(entry) + b"\n")
+    if level == "ERROR":
+        _OUT.flush()
 
 # --- Op Maturity: Health Server ---
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        if self.path == '/health':
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(b"OK")
-        else:
-            self.send_response(404)
-            self.end_headers()
+# Served from the main event loop, so no extra thread competes with the publish loop
+HEALTH_OK = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nOK"
+HEALTH_NOT_FOUND = b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
 
-    def log_message(self, format, *args):
+async def handle_health(reader, writer):
+    try:
+        # Bounded so a client that connects and never sends a request can't hold the handler open
+        async with asyncio.timeout(HEALTH_REQUEST_TIMEOUT):
+            request_line = await reader.readline()
+            # Drain the headers so closing the socket doesn't reset the connection
+            line = request_line
+            while line not in (b"\r\n", b"\n", b""):
+                line = await reader.readline()
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1] == b"/health":
+                writer.write(HEALTH_OK)
+            else:
+                writer.write(HEALTH_NOT_FOUND)
+            await writer.drain()
+    except Exception:
         pass
+    finally:
+        writer.close()
 
-def start_health_server():
+async def start_health_server():
     try:
-        server = HTTPServer(('0.0.0.0', HEALTH_PORT), HealthHandler)
+        server = await asyncio.start_server(handle_health, '0.0.0.0', HEALTH_PORT)
         log_json("INFO", f"Health server listening on port {HEALTH_PORT}", "HealthCheck")
-        server.serve_forever()
+        return server
     except Exception as e:
         log_json("ERROR", f"Failed to start health server: {e}", "HealthCheck")
+        return None
+
+# Keeps the latest pushed value per tag; the publish loop reads it without touching the wire
+class SubHandler:
+    def __init__(self, layout):
+        self.tag_keys = {node.nodeid: tag_name for tag_name, node in layout}
+        self.latest = {}
+        self.first_update = asyncio.Event()
+    
+    def datachange_notification(self, node, val, data):
+        key = self.tag_keys.get(node.nodeid)
+        if key is None:
+            return
+        self.latest[key] = val
+        self.first_update.set()
+    
+    def status_change_notification(self, status):
+        log_json("WARNING", f"Subscription status changed: {status}", "OPCUA")
+
+def _read_failed(tag_name, reason, failed):
+    if failed is None:
+        log_json("ERROR", f"Error reading {tag_name}: {reason}", "OPCUA")
+    else:
+        failed.add(tag_name)
+
+async def read_values(opcua_client, layout, failed=None):
+    # One Read service call for every tag; per-node reads only if the batch fails.
+    # Each DataValue carries its own StatusCode, so Bad or unknown tags are skipped: logged,
+    # or added to failed when the caller tracks them itself.
+    try:
+        data_values = await opcua_client.read_attributes([node for _, node in layout], ua.AttributeIds.Value)
+    except Exception as e:
+        log_json("WARNING", f"Batch read failed, falling back to per-node reads: {e}", "OPCUA")
+    else:
+        results = []
+        for (tag_name, _), dv in zip(layout, data_values):
+            if dv.StatusCode is not None and not dv.StatusCode.is_good():
+                _read_failed(tag_name, dv.StatusCode.name, failed)
+            elif dv.Value is None:
+                _read_failed(tag_name, "no value", failed)
+            else:
+                results.append((tag_name, dv.Value.Value))
+        return results
+    
+    # Issued concurrently so they pipeline over the one connection
+    values = await asyncio.gather(*(node.read_value() for _, node in layout), return_exceptions=True)
+    results = []
+    for (tag_name, _), value in zip(layout, values):
+        if isinstance(value, Exception):
+            _read_failed(tag_name, value, failed)
+        else:
+            results.append((tag_name, value))
+    return results
+
+# Reads the tags the subscription rejected. Their rejection is logged once at startup; a tag that
+# then fails to read is retried after a delay that doubles up to POLL_RETRY_MAX instead of every cycle.
+# retry maps tag name -> (next attempt, delay) in loop time.
+async def poll_rejected(opcua_client, polled, retry, now):
+    due = [entry for entry in polled if retry.get(entry[0], (0.0, 0.0))[0] <= now]
+    if not due:
+        return []
+    failed = set()
+    results = await read_values(opcua_client, due, failed)
+    for entry in due:
+        tag_name = entry[0]
+        if tag_name in failed:
+            delay = min(max(retry.get(tag_name, (0.0, 0.0))[1] * 2, PUBLISH_INTERVAL), POLL_RETRY_MAX)
+            retry[tag_name] = (now + delay, delay)
+        elif retry.pop(tag_name, None) is not None:
+            log_json("INFO", f"Polled tag {tag_name} is readable again", "OPCUA")
+    return results
+
+async def send_batch(iot_client, batch):
+    # The device SDK has no multi-message send, so samples are packed into one JSON array;
+    # a batch of one keeps the plain object format
+    payload = batch[0] if len(batch) == 1 else batch
+    body = _dumps(payload)
+    if TELEMETRY_ZSTD and _ZSTD is not None:
+        message = Message(_ZSTD.compress(body))
+        message.content_encoding = "zstd"
+        message.custom_properties["codec"] = "zstd"
+    else:
+        message = Message(body)
+        message.content_encoding = "utf-8"
+    message.content_type = "application/json"
+    message.custom_properties["batchSize"] = str(len(batch))
+    await iot_client.send_message(message)
+
+# Drains the send queue in batches so a slow or throttled IoT Hub never stalls collection
+async def send_loop(iot_client, send_queue, pending):
+    loop = asyncio.get_running_loop()
+    while True:
+        pending.append(await send_queue.get())
+        deadline = loop.time() + BATCH_MAX_AGE
+        while len(pending) < BATCH_SIZE:
+            try:
+                async with asyncio.timeout(max(0, deadline - loop.time())):
+                    pending.append(await send_queue.get())
+            except TimeoutError:
+                break
+        try:
+            await send_batch(iot_client, pending)
+            log_json("INFO", "Sent to IoT Hub", "IoTHub", batch_size=len(pending))
+        except Exception as e:
+            log_json("ERROR", f"Send failed: {e}", "IoTHub", batch_size=len(pending))
+        pending.clear()
 
 async def main():
     # Start Health Server
-    threading.Thread(target=start_health_server, daemon=True).start()
+    health_server = await start_health_server()
 
     log_json("INFO", "OPC-UA Gateway starting...", "Gateway")
     log_json("INFO", f"OPC-UA Endpoint: {OPCUA_ENDPOINT}")
     log_json("INFO", f"Publish Interval: {PUBLISH_INTERVAL} seconds")
+    if TELEMETRY_ZSTD and _ZSTD is None:
+        log_json("WARNING", "TELEMETRY_ZSTD is set but zstandard is not installed; sending uncompressed", "IoTHub")
     
     iot_client = None
     if IOT_HUB_CONNECTION_STRING:
-        iot_client = IoTHubDeviceClient.create_from_connection_string(IOT_HUB_CONNECTION_STRING)
+        # Plain MQTT over TCP (no WebSocket framing), one long-lived connection
+        iot_client = IoTHubDeviceClient.create_from_connection_string(
+            IOT_HUB_CONNECTION_STRING, websockets=False, keep_alive=IOT_HUB_KEEP_ALIVE
+        )
         await iot_client.connect()
         log_json("INFO", "Connected to Azure IoT Hub", "IoTHub")
     else:
         log_json("WARNING", "No IoT Hub connection string. Running in local-only mode.", "IoTHub")
     
     opcua_client = Client(OPCUA_ENDPOINT)
+    subscription = None
+    send_queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+    pending = []
+    sender = None
     
     try:
         await opcua_client.connect()
         log_json("INFO", f"Connected to OPC-UA server: {OPCUA_ENDPOINT}", "OPCUA")
         
-        nodes = []
+        # (tag name, node), resolved once so the loop does no string work
+        layout = []
         for tag in TAGS:
             try:
                 node = opcua_client.get_node(tag)
-                nodes.append((tag, node))
-                log_json("INFO", f"Subscribed to: {tag}", "OPCUA")
+                layout.append((tag.split("/")[-1], node))
+                log_json("INFO", f"Resolved node: {tag}", "OPCUA")
             except Exception as e:
-                log_json("ERROR", f"Failed to subscribe to {tag}: {e}", "OPCUA")
+                log_json("ERROR", f"Failed to resolve {tag}: {e}", "OPCUA")
+        
+        # Server pushes value changes; polling is only used for tags the subscription cannot cover
+        handler = SubHandler(layout)
+        polled = []
+        poll_retry = {}
+        try:
+            subscription = await opcua_client.create_subscription(SUBSCRIPTION_INTERVAL_MS, handler)
+            results = await subscription.subscribe_data_change([node for _, node in layout])
+            # Per-tag failures come back as a StatusCode in place of the monitored item handle
+            for entry, result in zip(layout, results):
+                if isinstance(result, ua.StatusCode):
+                    log_json("ERROR", f"Subscribe failed: {entry[0]} - {result.name}, polling instead", "OPCUA")
+                    polled.append(entry)
+            subscribed = len(layout) - len(polled)
+            log_json("INFO", f"Subscribed to {subscribed} tags ({SUBSCRIPTION_INTERVAL_MS} ms publishing interval), polling {len(polled)}", "OPCUA")
+            if subscribed:
+                try:
+                    await asyncio.wait_for(handler.first_update.wait(), timeout=10)
+                except asyncio.TimeoutError:
+                    log_json("WARNING", "No initial data change received within 10s", "OPCUA")
+        except Exception as e:
+            subscription = None
+            log_json("WARNING", f"Subscription failed, falling back to polling: {e}", "OPCUA")
         
+        if iot_client:
+            sender = asyncio.create_task(send_loop(iot_client, send_queue, pending))
+        dropped = 0
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
         while True:
+            timestamp = utc_timestamp()
+            if subscription is not None:
+                tags = handler.latest.copy()
+                if polled:
+                    tags.update(await poll_rejected(opcua_client, polled, poll_retry, loop.time()))
+            else:
+                tags = dict(await read_values(opcua_client, layout))
+            
             telemetry = {
-                "timestamp": datetime.utcnow().isoformat() + "Z",
-                "deviceId": os.getenv("HOSTNAME", "unknown"),
-                "tags": {}
+                "timestamp": timestamp,
+                "deviceId": DEVICE_ID,
+                "tags": tags
             }
             
-            for tag_path, node in nodes:
-                try:
-                    value = await node.read_value()
-                    tag_name = tag_path.split("/")[-1]
-                    telemetry["tags"][tag_name] = value
-                except Exception as e:
-                    log_json("ERROR", f"Error reading {tag_path}: {e}", "OPCUA")
-            
-            log_json("INFO", f"Telemetry collected", "Telemetry", data_preview=str(telemetry["tags"]))
+            log_json("INFO", f"Telemetry collected", "Telemetry", ts=timestamp, data_preview=str(telemetry["tags"]))
             
             if iot_client:
-                message = Message(json.dumps(telemetry))
-                message.content_type = "application/json"
-                message.content_encoding = "utf-8"
-                await iot_client.send_message(message)
-                log_json("INFO", "Sent to IoT Hub", "IoTHub")
+                if send_queue.full():
+                    # Drop the oldest sample rather than stall collection while IoT Hub is slow
+                    send_queue.get_nowait()
+                    dropped += 1
+                    if dropped % 100 == 1:
+                        log_json("WARNING", f"Send queue full, {dropped} samples dropped so far", "IoTHub", ts=timestamp)
+                send_queue.put_nowait(telemetry)
             
-            await asyncio.sleep(PUBLISH_INTERVAL)
+            # Sleep until the next deadline so the time spent in the cycle doesn't stretch the interval
+            next_tick += PUBLISH_INTERVAL
+            delay = next_tick - loop.time()
+            if delay < 0:
+                # Overran the deadline: resync instead of bursting to catch up
+                next_tick = loop.time()
+                delay = 0
+            _OUT.flush()
+            await asyncio.sleep(delay)
             
     except Exception as e:
         log_json("ERROR", f"Fatal Error: {e}", "System")
     finally:
+        if sender is not None:
+            sender.cancel()
+            try:
+                await sender
+            except asyncio.CancelledError:
+                pass
+            # Whatever the sender was holding plus anything still queued
+            remaining = list(pending)
+            while not send_queue.empty():
+                remaining.append(send_queue.get_nowait())
+            for i in range(0, len(remaining), BATCH_SIZE):
+                batch = remaining[i:i + BATCH_SIZE]
+                try:
+                    await send_batch(iot_client, batch)
+                except Exception as e:
+                    log_json("ERROR", f"Final batch send failed: {e}", "IoTHub", batch_size=len(batch))
+        if subscription is not None:
+            try:
+                await subscription.delete()
+            except Exception:
+                pass
         try:
             await opcua_client.disconnect()
         except:
@@ -125,6 +365,11 @@ async def main():
                  await iot_client.disconnect()
              except:
                  pass
+        if health_server:
+            health_server.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
@@ -2,49 +2,109 @@
 import random
 import math
 import json
-import threading
-from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import sys
+import atexit
+import signal
+import time
+from datetime import datetime, timezone
 from asyncua import Server, ua
 
+# libuv-based event loop when available; stock asyncio otherwise
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 HEALTH_PORT = 8080
+HEALTH_REQUEST_TIMEOUT = 5.0  # Seconds a health client has to send its request
+UPDATE_INTERVAL = 1.0
+
+# Block-buffered stdout: flushed once per loop iteration, on ERROR, at exit and on SIGTERM
+_OUT = open(1, "wb", buffering=64 * 1024, closefd=False)
+atexit.register(_OUT.flush)
+
+def _handle_sigterm(signum, frame):
+    _OUT.flush()
+    sys.exit(0)
+
+signal.signal(signal.SIGTERM, _handle_sigterm)
 
 # --- Op Maturity: Structured Logging ---
+# Formatted date/time of the current second, reused until the second rolls over
+_TS_CACHE = [None, ""]
+
+def utc_timestamp():
+    seconds, nanos = divmod(time.time_ns(), 1_000_000_000)
+    if seconds != _TS_CACHE[0]:
+        _TS_CACHE[0] = seconds
+        _TS_CACHE[1] = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds))
+    return f"{_TS_CACHE[1]}.{nanos // 1000:06d}Z"
+
 def log_json(level, message, component="OPCUASimulator", **kwargs):
     entry = {
-        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "timestamp": utc_timestamp(),
         "level": level,
         "component": component,
         "message": message,
         **kwargs
     }
-    print(json.dumps(entry), flush=True)
+    _OUT.write(json.dumps(entry).encode("utf-8") + b"\n")
+    if level == "ERROR":
+        _OUT.flush()
 
 # --- Op Maturity: Health Server ---
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        if self.path == '/health':
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(b"OK")
-        else:
-            self.send_response(404)
-            self.end_headers()
-
-    def log_message(self, format, *args):
+# Served from the main event loop, so no extra thread competes with the update loop
+HEALTH_OK = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nOK"
+HEALTH_NOT_FOUND = b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+
+async def handle_health(reader, writer):
+    try:
+        # Bounded so a client that connects and never sends a request can't hold the handler open
+        async with asyncio.timeout(HEALTH_REQUEST_TIMEOUT):
+            request_line = await reader.readline()
+            # Drain the headers so closing the socket doesn't reset the connection
+            line = request_line
+            while line not in (b"\r\n", b"\n", b""):
+                line = await reader.readline()
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1] == b"/health":
+                writer.write(HEALTH_OK)
+            else:
+                writer.write(HEALTH_NOT_FOUND)
+            await writer.drain()
+    except Exception:
         pass
+    finally:
+        writer.close()
 
-def start_health_server():
+async def start_health_server():
     try:
-        server = HTTPServer(('0.0.0.0', HEALTH_PORT), HealthHandler)
+        server = await asyncio.start_server(handle_health, '0.0.0.0', HEALTH_PORT)
         log_json("INFO", f"Health server listening on port {HEALTH_PORT}", "HealthCheck")
-        server.serve_forever()
+        return server
     except Exception as e:
         log_json("ERROR", f"Failed to start health server: {e}", "HealthCheck")
+        return None
+
+async def write_values(server, nodes, values):
+    # One Write service call on the server's internal session instead of an await per variable
+    now = datetime.now(timezone.utc)
+    params = ua.WriteParameters()
+    params.NodesToWrite = [
+        ua.WriteValue(
+            NodeId=node.nodeid,
+            AttributeId=ua.AttributeIds.Value,
+            Value=ua.DataValue(ua.Variant(value), SourceTimestamp=now),
+        )
+        for node, value in zip(nodes, values)
+    ]
+    for result in await server.iserver.isession.write(params):
+        result.check()
+
 
 async def main():
     # Start Health Server
-    threading.Thread(target=start_health_server, daemon=True).start()
+    health_server = await start_health_server()
 
     server = Server()
     await server.init()
@@ -92,36 +152,58 @@ async def main():
     
     async with server:
         cycle = 0
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
         while True:
-            await asyncio.sleep(1)
+            # Sleep until the next deadline so the time spent in the cycle doesn't stretch the interval
+            next_tick += UPDATE_INTERVAL
+            delay = next_tick - loop.time()
+            if delay < 0:
+                # Overran the deadline: resync instead of bursting to catch up
+                next_tick = loop.time()
+                delay = 0
+            _OUT.flush()
+            await asyncio.sleep(delay)
             cycle += 1
             
-            await cycle_count.write_value(cycle)
+            # Collected per tick and written in one call
+            nodes = [cycle_count]
+            values = [cycle]
             
             if cycle % 5 == 0:
                 if random.random() > 0.05:
                     current_good = await parts_good.read_value()
-                    await parts_good.write_value(current_good + 1)
+                    nodes.append(parts_good)
+                    values.append(current_good + 1)
                 else:
                     current_bad = await parts_bad.read_value()
-                    await parts_bad.write_value(current_bad + 1)
+                    nodes.append(parts_bad)
+                    values.append(current_bad + 1)
             
             base_temp = 72.0
             temp_variation = math.sin(cycle / 30) * 5 + random.uniform(-1, 1)
-            await temperature.write_value(round(base_temp + temp_variation, 2))
+            nodes.append(temperature)
+            values.append(round(base_temp + temp_variation, 2))
             
             base_pressure = 14.7
             pressure_variation = math.sin(cycle / 60) * 0.5 + random.uniform(-0.1, 0.1)
-            await pressure.write_value(round(base_pressure + pressure_variation, 2))
+            nodes.append(pressure)
+            values.append(round(base_pressure + pressure_variation, 2))
             
             base_vibration = 0.5
+            nodes.append(vibration)
             if random.random() > 0.98:
-                await vibration.write_value(round(random.uniform(2.0, 5.0), 2))
+                values.append(round(random.uniform(2.0, 5.0), 2))
             else:
-                await vibration.write_value(round(base_vibration + random.uniform(-0.2, 0.2), 2))
+                values.append(round(base_vibration + random.uniform(-0.2, 0.2), 2))
+            
+            await write_values(server, nodes, values)
             
             if cycle % 10 == 0:
                 log_json("INFO", f"Cycle {cycle}: Temp={round(base_temp + temp_variation, 1)}", "PLC")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
@@ -1,14 +1,25 @@
 ﻿import os
 import json
+import atexit
 import csv
 import time
 import hashlib
+import queue
+import re
+import signal
+import tempfile
 import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import PatternMatchingEventHandler
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core.pipeline.transport import RequestsTransport
+from azure.core.exceptions import ResourceExistsError
 from azure.storage.blob import BlobServiceClient
 from azure.iot.device import IoTHubDeviceClient, Message
 
@@ -17,18 +28,103 @@ BLOB_CONNECTION_STRING = os.getenv("BLOB_CONNECTION_STRING", "")
 BLOB_CONTAINER = os.getenv("BLOB_CONTAINER", "test-results")
 IOT_HUB_CONNECTION_STRING = os.getenv("IOT_HUB_CONNECTION_STRING", "")
 DEVICE_ID = os.getenv("HOSTNAME", "unknown-device")
+BLOB_MAX_CONCURRENCY = int(os.getenv("BLOB_MAX_CONCURRENCY", "2"))
+# Uploads above one block are split and sent in parallel; documents up to one block are spooled in memory
+BLOB_BLOCK_SIZE = 4 * 1024 * 1024
+UPLOAD_WORKERS = max(1, int(os.getenv("UPLOAD_WORKERS", "2")))
+# Memory budget (128Mi pod limit): each worker holds one spooled block plus one buffered block per
+# parallel block upload, so blocks in flight across all workers are capped at 4 x 4 MiB
+BLOB_MAX_INFLIGHT_BLOCKS = 4
+BLOB_UPLOAD_CONCURRENCY = max(1, min(BLOB_MAX_CONCURRENCY, BLOB_MAX_INFLIGHT_BLOCKS // UPLOAD_WORKERS))
+# Keep-alive connections held open to the storage account, one per block upload that can be in flight
+BLOB_POOL_SIZE = UPLOAD_WORKERS * BLOB_UPLOAD_CONCURRENCY
+SUMMARY_BATCH_SIZE = int(os.getenv("SUMMARY_BATCH_SIZE", "100"))
+SUMMARY_BATCH_MAX_AGE = float(os.getenv("SUMMARY_BATCH_MAX_AGE", "1.0"))
+# IoT Hub caps device-to-cloud messages at 256 KB; the rest is headroom for properties
+SUMMARY_MAX_MESSAGE_BYTES = 250 * 1024
+SUMMARY_QUEUE_SIZE = 1000
+# Hashes of the most recently processed files remembered for dedup
+MAX_PROCESSED = int(os.getenv("MAX_PROCESSED", "10000"))
 HEALTH_PORT = 8080
 
+# Page-cache hints: each result file is read front to back (once to hash, once to parse) and not
+# needed afterwards, so readahead is widened and the pages dropped after the parse; no-ops off Linux
+if hasattr(os, "posix_fadvise"):
+    def fadvise_sequential(f):
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    
+    def fadvise_done(f):
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+else:
+    def fadvise_sequential(f):
+        pass
+    
+    def fadvise_done(f):
+        pass
+
+# CSV header naming the column that carries the test's outcome
+_RESULT_COLUMN = re.compile(r"result|status", re.IGNORECASE)
+
+try:
+    import orjson
+    
+    def _dumps(obj):
+        # CSV rows with surplus fields carry a None key (DictReader's restkey)
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+# Block-buffered stdout: flushed after each file and summary batch, on ERROR and at exit
+_OUT = open(1, "wb", buffering=64 * 1024, closefd=False)
+atexit.register(_OUT.flush)
+
 # --- Op Maturity: Structured Logging ---
+# Formatted date/time of the current second, reused until the second rolls over; kept as one
+# tuple so threads logging concurrently never see a half-updated cache
+_TS_CACHE = (None, "")
+
+def utc_timestamp():
+    global _TS_CACHE
+    seconds, nanos = divmod(time.time_ns(), 1_000_000_000)
+    cached_seconds, prefix = _TS_CACHE
+    if seconds != cached_seconds:
+        prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds))
+        _TS_CACHE = (seconds, prefix)
+    return f"{prefix}.{nanos // 1000:06d}Z"
+
 def log_json(level, message, component="TestCollector", **kwargs):
+    if not kwargs:
+        get_logger(level, component)(message)
+        return
     entry = {
-        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "timestamp": utc_timestamp(),
         "level": level,
         "component": component,
         "message": message,
         **kwargs
     }
-    print(json.dumps(entry), flush=True)
+    _OUT.write(_dumps(entry) + b"\n")
+    if level == "ERROR":
+        _OUT.flush()
+
+# One specialised writer per (level, component): everything but the timestamp and message is
+# encoded once, so plain log lines skip building and serialising the entry dict
+_LOGGERS = {}
+
+def get_logger(level, component):
+    log = _LOGGERS.get((level, component))
+    if log is None:
+        middle = b'","level":' + _dumps(level) + b',"component":' + _dumps(component) + b',"message":'
+        flush = level == "ERROR"
+        
+        def log(message):
+            _OUT.write(b'{"timestamp":"' + utc_timestamp().encode() + middle + _dumps(message) + b"}\n")
+            if flush:
+                _OUT.flush()
+        
+        _LOGGERS[(level, component)] = log
+    return log
 
 # --- Op Maturity: Health Server ---
 class HealthHandler(BaseHTTPRequestHandler):
@@ -48,125 +144,282 @@ def start_health_server():
     try:
         server = HTTPServer(('0.0.0.0', HEALTH_PORT), HealthHandler)
         log_json("INFO", f"Health server listening on port {HEALTH_PORT}", "HealthCheck")
+        _OUT.flush()
         server.serve_forever()
     except Exception as e:
         log_json("ERROR", f"Failed to start health server: {e}", "HealthCheck")
 
-class TestResultHandler(FileSystemEventHandler):
-    def __init__(self, blob_service, iot_client):
-        self.blob_service = blob_service
-        self.iot_client = iot_client
-        self.processed_files = set()
+class TestResultHandler(PatternMatchingEventHandler):
+    def __init__(self, container_client, summary_queue):
+        # Only result files reach the handler; temp and lock files are filtered out by watchdog
+        super().__init__(patterns=['*.csv', '*.json'], ignore_directories=True, case_sensitive=False)
+        self.container_client = container_client
+        self.summary_queue = summary_queue
+        # Bounded LRU of file hashes so a long-running collector doesn't grow without limit
+        self.processed_files = OrderedDict()
+        # Hashes being processed right now, so the same content isn't picked up twice in parallel
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        # Files are hashed, parsed and uploaded off the watchdog thread, several at a time
+        self.pool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="upload")
     
-    def on_created(self, event):
-        if event.is_directory:
-            return
-        
-        filepath = event.src_path
+    def on_closed(self, event):
+        # Fired when the writer closes the file (IN_CLOSE_WRITE), so the contents are complete
+        self.pool.submit(self._process, event.src_path)
+    
+    def on_moved(self, event):
+        # Writers that write a temp file and rename it into place never close the final name.
+        # Dispatch lets the event through if either end matches, so only result destinations are
+        # taken; a rename that also closed the file is deduplicated by hash in _process
+        if event.dest_path.lower().endswith(('.csv', '.json')):
+            self.pool.submit(self._process, event.dest_path)
+    
+    def _process(self, filepath):
         filename = os.path.basename(filepath)
         
-        if not filename.lower().endswith(('.csv', '.json')):
-            return
-        
-        # Wait for file to be fully written
-        time.sleep(1)
-        
         file_hash = self._get_file_hash(filepath)
-        if file_hash in self.processed_files:
-            return
+        # First 64 bits of the digest as an int: a fraction of the memory of the hex string per entry.
+        # Files that couldn't be hashed have no key and are always attempted, outside the dedup.
+        key = int(file_hash[:16], 16) if file_hash is not None else None
+        if key is not None:
+            with self.lock:
+                if key in self.processed_files:
+                    self.processed_files.move_to_end(key)
+                    return
+                if key in self.in_flight:
+                    return
+                self.in_flight.add(key)
         
         log_json("INFO", f"New test result detected: {filename}", "Watcher")
         
+        # CSV rows are written into the upload document as they are parsed; spills to /tmp past one block
+        stream = tempfile.SpooledTemporaryFile(max_size=BLOB_BLOCK_SIZE) if self.container_client else None
         try:
-            test_data = self._parse_file(filepath)
+            test_data = self._parse_file(filepath, stream)
+            # One clock read for the metadata and the blob's date path
+            now = datetime.utcnow()
             
             test_data["metadata"] = {
                 "sourceFile": filename,
                 "deviceId": DEVICE_ID,
-                "uploadTimestamp": datetime.utcnow().isoformat() + "Z",
+                "uploadTimestamp": now.isoformat() + "Z",
                 "fileHash": file_hash
             }
             
             blob_name = None
-            if self.blob_service:
-                blob_name = f"{DEVICE_ID}/{datetime.utcnow().strftime('%Y/%m/%d')}/{filename}.json"
-                blob_client = self.blob_service.get_blob_client(container=BLOB_CONTAINER, blob=blob_name)
-                blob_client.upload_blob(json.dumps(test_data, indent=2), overwrite=True)
+            if self.container_client:
+                blob_name = f"{DEVICE_ID}/{now.strftime('%Y/%m/%d')}/{filename}.json"
+                length = self._write_json(stream, test_data)
+                self.container_client.upload_blob(
+                    blob_name,
+                    stream,
+                    length=length,
+                    overwrite=True,
+                    max_concurrency=BLOB_UPLOAD_CONCURRENCY
+                )
                 log_json("INFO", f"Uploaded to Blob: {blob_name}", "BlobStorage")
             
-            if self.iot_client:
+            if self.summary_queue is not None:
                 summary = {
                     "messageType": "testResult",
                     "deviceId": DEVICE_ID,
-                    "timestamp": datetime.utcnow().isoformat() + "Z",
+                    "timestamp": utc_timestamp(),
                     "testId": test_data.get("testId", filename),
                     "result": test_data.get("result", "UNKNOWN"),
                     "blobPath": blob_name
                 }
-                message = Message(json.dumps(summary))
-                message.content_type = "application/json"
-                self.iot_client.send_message(message)
-                log_json("INFO", "Sent summary to IoT Hub", "IoTHub")
+                # Sent by send_summaries so a slow IoT Hub doesn't hold up the watcher
+                try:
+                    self.summary_queue.put_nowait(_dumps(summary))
+                except queue.Full:
+                    log_json("WARNING", "Summary queue full; dropping summary", "IoTHub", sourceFile=filename)
             
-            self.processed_files.add(file_hash)
+            if key is not None:
+                with self.lock:
+                    self.processed_files[key] = None
+                    if len(self.processed_files) > MAX_PROCESSED:
+                        self.processed_files.popitem(last=False)
             log_json("INFO", "Processing complete", "Handler")
             
         except Exception as e:
             log_json("ERROR", f"Error processing {filename}: {e}", "Handler")
+        finally:
+            if key is not None:
+                with self.lock:
+                    self.in_flight.discard(key)
+            if stream is not None:
+                stream.close()
+            _OUT.flush()
+    
+    def _write_json(self, stream, data):
+        # Completes the document in stream and rewinds it; returns its length
+        if stream.tell():
+            # _parse_file already opened the object with the streamed rows
+            stream.write(b"," + _dumps(data)[1:])
+        else:
+            # Encoded straight to bytes, with no intermediate str
+            stream.write(_dumps(data))
+        length = stream.tell()
+        stream.seek(0)
+        return length
     
     def _get_file_hash(self, filepath):
+        # Streamed in chunks so memory stays flat regardless of file size
         try:
-            with open(filepath, 'rb') as f:
-                return hashlib.md5(f.read()).hexdigest()
+            with open(filepath, 'rb', buffering=0) as f:
+                # Pages stay cached for the parse that follows
+                fadvise_sequential(f)
+                return hashlib.file_digest(f, lambda: hashlib.blake2b(digest_size=16)).hexdigest()
         except:
-            return str(time.time())
+            # Unreadable: no hash, so the file is still attempted and nothing is recorded for it
+            return None
     
-    def _parse_file(self, filepath):
+    def _parse_file(self, filepath, stream=None):
         filename = os.path.basename(filepath).lower()
         
         if filename.endswith('.json'):
             with open(filepath, 'r') as f:
-                return json.load(f)
+                fadvise_sequential(f)
+                data = json.load(f)
+                fadvise_done(f)
+                return data
         
         elif filename.endswith('.csv'):
             with open(filepath, 'r') as f:
-                reader = csv.DictReader(f)
-                rows = list(reader)
+                fadvise_sequential(f)
+                # Positional reader; rows only become dicts when they are written to the upload
+                reader = csv.reader(f)
+                fieldnames = next(reader, [])
+                width = len(fieldnames)
+                # Result column picked once from the header instead of scanning every cell
+                result_key = next((key for key in fieldnames if _RESULT_COLUMN.search(key)), None)
+                if result_key is not None:
+                    # A repeated header name keeps its last column, as a dict built from the row would
+                    result_index = width - 1 - fieldnames[::-1].index(result_key)
+                
+                # Single pass: rows go straight into the upload stream instead of being held in a list
+                if stream is not None:
+                    stream.write(b'{"data":[')
+                count = 0
+                last = None
+                for values in reader:
+                    if not values:
+                        # Blank lines are skipped, as csv.DictReader did
+                        continue
+                    last = values
+                    if stream is not None:
+                        row = dict(zip(fieldnames, values))
+                        if len(values) > width:
+                            row[None] = values[width:]
+                        elif len(values) < width:
+                            for key in fieldnames[len(values):]:
+                                row[key] = None
+                        if count:
+                            stream.write(b",")
+                        stream.write(_dumps(row))
+                    count += 1
+                if stream is not None:
+                    stream.write(b"]")
+                fadvise_done(f)
                 
                 result = {
                     "testId": os.path.splitext(os.path.basename(filepath))[0],
-                    "recordCount": len(rows),
-                    "data": rows,
+                    "recordCount": count,
                     "result": "UNKNOWN"
                 }
                 
-                for row in rows:
-                    for key, value in row.items():
-                        if 'result' in key.lower() or 'status' in key.lower():
-                            result["result"] = value
-                            break
+                # The last row's value wins, as before
+                if last is not None and result_key is not None:
+                    result["result"] = last[result_index] if result_index < len(last) else None
                 
                 return result
         
         return {"raw": open(filepath, 'r').read()}
 
+def send_message_batch(iot_client, bodies):
+    # The device SDK has no multi-message send, so summaries are packed into one JSON array;
+    # a batch of one keeps the plain object format
+    payload = bodies[0] if len(bodies) == 1 else b"[" + b",".join(bodies) + b"]"
+    message = Message(payload)
+    message.content_type = "application/json"
+    message.custom_properties["batchSize"] = str(len(bodies))
+    iot_client.send_message(message)
+
+# Drains the summary queue in batches of up to SUMMARY_BATCH_SIZE, SUMMARY_BATCH_MAX_AGE or
+# SUMMARY_MAX_MESSAGE_BYTES, whichever comes first; a None entry stops it after a final send
+def send_summaries(iot_client, summary_queue):
+    carry = None
+    running = True
+    while running:
+        body = carry if carry is not None else summary_queue.get()
+        carry = None
+        if body is None:
+            break
+        batch = [body]
+        size = len(body) + 2
+        deadline = time.monotonic() + SUMMARY_BATCH_MAX_AGE
+        while len(batch) < SUMMARY_BATCH_SIZE:
+            try:
+                body = summary_queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if body is None:
+                running = False
+                break
+            if size + len(body) + 1 > SUMMARY_MAX_MESSAGE_BYTES:
+                # Starts the next batch instead
+                carry = body
+                break
+            batch.append(body)
+            size += len(body) + 1
+        try:
+            send_message_batch(iot_client, batch)
+            log_json("INFO", "Sent summaries to IoT Hub", "IoTHub", batch_size=len(batch))
+        except Exception as e:
+            log_json("ERROR", f"Send failed: {e}", "IoTHub", batch_size=len(batch))
+        _OUT.flush()
+
 def main():
     threading.Thread(target=start_health_server, daemon=True).start()
 
     log_json("INFO", "Test Data Collector starting...", "Collector")
     log_json("INFO", f"Watching directory: {WATCH_DIR}")
     log_json("INFO", f"Blob container: {BLOB_CONTAINER}")
+    log_json("INFO", f"Upload workers: {UPLOAD_WORKERS}, block uploads per file: {BLOB_UPLOAD_CONCURRENCY}")
+    if BLOB_UPLOAD_CONCURRENCY < BLOB_MAX_CONCURRENCY:
+        log_json("WARNING", f"BLOB_MAX_CONCURRENCY={BLOB_MAX_CONCURRENCY} lowered to {BLOB_UPLOAD_CONCURRENCY} "
+                 f"to keep {UPLOAD_WORKERS} workers within {BLOB_MAX_INFLIGHT_BLOCKS} blocks in flight", "BlobStorage")
     
-    blob_service = None
+    container_client = None
     if BLOB_CONNECTION_STRING:
         try:
-            blob_service = BlobServiceClient.from_connection_string(BLOB_CONNECTION_STRING)
+            # One pooled session shared by every upload so block requests reuse warm TLS connections
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=BLOB_POOL_SIZE))
+            blob_service = BlobServiceClient.from_connection_string(
+                BLOB_CONNECTION_STRING,
+                transport=RequestsTransport(session=session, connection_timeout=20),
+                max_block_size=BLOB_BLOCK_SIZE,
+                max_single_put_size=BLOB_BLOCK_SIZE
+            )
+            # Built once and reused, rather than a new blob client URL and pipeline wrapper per file
+            container_client = blob_service.get_container_client(BLOB_CONTAINER)
             log_json("INFO", "Connected to Azure Blob Storage", "BlobStorage")
         except Exception as e:
             log_json("WARNING", f"Failed to connect to Blob Storage: {e}", "BlobStorage")
     else:
         log_json("WARNING", "No Blob connection string. Files will not be uploaded.", "BlobStorage")
     
+    if container_client:
+        try:
+            container_client.create_container()
+            log_json("INFO", f"Created blob container: {BLOB_CONTAINER}", "BlobStorage")
+        except ResourceExistsError:
+            pass
+        except Exception as e:
+            # Credentials scoped to an existing container may not be allowed to create one
+            log_json("WARNING", f"Could not ensure blob container exists: {e}", "BlobStorage")
+    
     iot_client = None
     if IOT_HUB_CONNECTION_STRING:
         try:
@@ -178,9 +431,16 @@ def main():
     else:
         log_json("WARNING", "No IoT Hub connection string. Summaries will not be sent.", "IoTHub")
     
+    summary_queue = None
+    sender = None
+    if iot_client:
+        summary_queue = queue.Queue(maxsize=SUMMARY_QUEUE_SIZE)
+        sender = threading.Thread(target=send_summaries, args=(iot_client, summary_queue), daemon=True)
+        sender.start()
+    
     Path(WATCH_DIR).mkdir(parents=True, exist_ok=True)
     
-    handler = TestResultHandler(blob_service, iot_client)
+    handler = TestResultHandler(container_client, summary_queue)
     observer = Observer()
     observer.schedule(handler, WATCH_DIR, recursive=False)
     observer.start()
@@ -188,14 +448,22 @@ def main():
     log_json("INFO", "Watching for test results...", "Collector")
     log_json("INFO", f"Drop .csv or .json files into {WATCH_DIR} to process them.", "Collector")
     
-    try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        observer.stop()
-        log_json("INFO", "Stopping observer", "System")
+    # Block until Ctrl-C or SIGTERM instead of waking every second
+    stop_event = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    _OUT.flush()
+    stop_event.wait()
     
+    observer.stop()
+    log_json("INFO", "Stopping observer", "System")
     observer.join()
+    # Let uploads already in progress finish before the summaries are flushed
+    handler.pool.shutdown(wait=True)
+    if sender:
+        # Flush what is still queued before disconnecting
+        summary_queue.put(None)
+        sender.join(timeout=10)
     if iot_client:
         try:
             iot_client.disconnect()
@@ -12,12 +12,18 @@ This shows the platform handles quality/inspection data, not just time-series.
 """
 
 import asyncio
+import atexit
+import bisect
+import itertools
 import json
 import os
 import random
-import uuid
+import signal
+import sys
+import time
 import threading
 from datetime import datetime
+import numpy as np
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from azure.iot.device.aio import IoTHubDeviceClient
 from azure.iot.device import Message
@@ -27,18 +33,76 @@ IOT_HUB_CONNECTION_STRING = os.getenv("IOT_HUB_CONNECTION_STRING", "")
 INSPECTION_INTERVAL = float(os.getenv("INSPECTION_INTERVAL", "5"))
 DEVICE_ID = os.getenv("DEVICE_ID", "vision-station-04")
 PASS_RATE = float(os.getenv("PASS_RATE", "0.95"))
+# Inspections' worth of random draws generated per refill
+DRAW_BUFFER_SIZE = 256
 HEALTH_PORT = 8080
 
+try:
+    import orjson
+    _dumps = orjson.dumps
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+# Block-buffered stdout: flushed once per inspection cycle, on ERROR, at exit and on SIGTERM
+_OUT = open(1, "wb", buffering=64 * 1024, closefd=False)
+atexit.register(_OUT.flush)
+
+def _handle_sigterm(signum, frame):
+    _OUT.flush()
+    sys.exit(0)
+
+signal.signal(signal.SIGTERM, _handle_sigterm)
+
 # --- Op Maturity: Structured Logging ---
+# Formatted date/time of the current second, reused until the second rolls over; kept as one
+# tuple so threads logging concurrently never see a half-updated cache
+_TS_CACHE = (None, "")
+
+def utc_timestamp():
+    global _TS_CACHE
+    seconds, nanos = divmod(time.time_ns(), 1_000_000_000)
+    cached_seconds, prefix = _TS_CACHE
+    if seconds != cached_seconds:
+        prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds))
+        _TS_CACHE = (seconds, prefix)
+    return f"{prefix}.{nanos // 1000:06d}Z"
+
 def log_json(level, message, component="VisionSimulator", **kwargs):
+    if not kwargs:
+        get_logger(level, component)(message)
+        return
     entry = {
-        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "timestamp": utc_timestamp(),
         "level": level,
         "component": component,
         "message": message,
         **kwargs
     }
-    print(json.dumps(entry), flush=True)
+    _OUT.write(_dumps(entry) + b"\n")
+    if level == "ERROR":
+        _OUT.flush()
+
+# One specialised writer per (level, component): everything but the timestamp and message is
+# encoded once, so plain log lines skip building and serialising the entry dict
+_LOGGERS = {}
+
+def get_logger(level, component):
+    log = _LOGGERS.get((level, component))
+    if log is None:
+        middle = b'","level":' + _dumps(level) + b',"component":' + _dumps(component) + b',"message":'
+        flush = level == "ERROR"
+        
+        def log(message):
+            _OUT.write(b'{"timestamp":"' + utc_timestamp().encode() + middle + _dumps(message) + b"}\n")
+            if flush:
+                _OUT.flush()
+        
+        _LOGGERS[(level, component)] = log
+    return log
+
+# Bound once for the line logged on every inspection
+log_inspection = get_logger("INFO", "Inspection")
 
 # --- Op Maturity: Health Server ---
 class HealthHandler(BaseHTTPRequestHandler):
@@ -71,6 +135,10 @@ DEFECT_TYPES = {
     "Dimensional": 0.05
 }
 
+# Cumulative distribution built once; the same running sums the per-call scan used to compute
+_DEFECT_NAMES = list(DEFECT_TYPES)
+_DEFECT_CUM = list(itertools.accumulate(DEFECT_TYPES.values()))
+
 PART_TYPES = ["Housing-A1", "Cover-B2", "Bracket-C3", "Frame-D4"]
 
 CAMERAS = [
@@ -79,16 +147,52 @@ CAMERAS = [
     {"id": "CAM-03", "position": "Side-Right", "resolution": "5MP"},
 ]
 
+# Per-camera fields that never change, merged with each inspection's timings
+_CAM_TEMPLATES = [{"cameraId": cam["id"], "position": cam["position"]} for cam in CAMERAS]
+_CAM_IDS = [cam["id"] for cam in CAMERAS]
+
+SEVERITIES = ["Minor", "Major", "Critical"]
+
 
 class VisionInspectionStation:
     def __init__(self):
         self.inspection_count = 0
         self.pass_count = 0
         self.fail_count = 0
-        self.current_batch = str(uuid.uuid4())[:8].upper()
+        self._rng = np.random.default_rng()
+        self.current_batch = self._new_batch_id()
         self.batch_count = 0
         self.batch_size = random.randint(50, 100)
         self.defect_counts = {defect: 0 for defect in DEFECT_TYPES}
+        self._draws = iter(())
+        
+    def _new_batch_id(self):
+        # Same 8 uppercase hex characters as the old uuid4 prefix, from the existing generator
+        return f"{int(self._rng.integers(0, 1 << 32)):08X}"
+    
+    def _generate_draws(self):
+        """Draw DRAW_BUFFER_SIZE inspections' random values in bulk, one tuple per inspection"""
+        rng = self._rng
+        k = DRAW_BUFFER_SIZE
+        n = len(CAMERAS)
+        # Bounds match the random.randint/uniform calls they replace (integers() excludes high);
+        # tolist() hands back plain Python ints and floats for rounding and JSON encoding
+        return zip(
+            rng.random(k).tolist(),                           # pass/fail
+            rng.integers(0, len(PART_TYPES), k).tolist(),     # part type
+            rng.integers(100000, 1000000, k).tolist(),        # part serial
+            rng.integers(120, 201, k).tolist(),               # process time
+            rng.uniform(0.92, 0.99, k).tolist(),              # confidence
+            rng.integers(15, 31, (k, n)).tolist(),            # capture time per camera
+            rng.integers(30, 61, (k, n)).tolist(),            # analysis time per camera
+            rng.uniform(0.95, 1.0, (k, n)).tolist(),          # image quality per camera
+            rng.random(k).tolist(),                           # defect type
+            rng.integers(0, len(SEVERITIES), k).tolist(),     # defect severity
+            rng.integers(100, 901, (k, 2)).tolist(),          # defect x, y
+            rng.integers(10, 101, (k, 2)).tolist(),           # defect width, height
+            rng.integers(0, n, k).tolist(),                   # detecting camera
+            rng.uniform(0.85, 0.98, k).tolist(),              # defect confidence
+        )
         
     def perform_inspection(self) -> dict:
         """Simulate a single inspection event"""
@@ -97,18 +201,28 @@ class VisionInspectionStation:
         
         # Check for batch rollover
         if self.batch_count >= self.batch_size:
-            self.current_batch = str(uuid.uuid4())[:8].upper()
+            self.current_batch = self._new_batch_id()
             self.batch_count = 0
             self.batch_size = random.randint(50, 100)
             log_json("INFO", f"New batch started: {self.current_batch}", "Batch")
         
-        inspection_id = f"INS-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}-{self.inspection_count:06d}"
-        passed = random.random() < PASS_RATE
-        part_type = random.choice(PART_TYPES)
-        part_serial = f"{part_type}-{random.randint(100000, 999999)}"
+        draws = next(self._draws, None)
+        if draws is None:
+            self._draws = self._generate_draws()
+            draws = next(self._draws)
+        (pass_draw, part_index, serial, process_time, confidence, capture_times, analysis_times,
+         qualities, defect_draw, severity_index, (x, y), (width, height), camera_index,
+         defect_confidence) = draws
+        
+        # One clock read for the inspection ID and the result timestamp
+        now = datetime.utcnow()
+        inspection_id = f"INS-{now.strftime('%Y%m%d%H%M%S')}-{self.inspection_count:06d}"
+        passed = pass_draw < PASS_RATE
+        part_type = PART_TYPES[part_index]
+        part_serial = f"{part_type}-{serial}"
         
         result = {
-            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "timestamp": now.isoformat() + "Z",
             "deviceId": DEVICE_ID,
             "dataType": "vision_inspection",
             "inspection": {
@@ -117,10 +231,15 @@ class VisionInspectionStation:
                 "partType": part_type,
                 "partSerial": part_serial,
                 "result": "PASS" if passed else "FAIL",
-                "processTimeMs": random.randint(120, 200),
-                "confidence": round(random.uniform(0.92, 0.99), 3)
+                "processTimeMs": process_time,
+                "confidence": round(confidence, 3)
             },
-            "cameras": [],
+            "cameras": [
+                {**template, "captureTimeMs": capture_time, "analysisTimeMs": analysis_time,
+                 "imageQuality": round(quality, 3)}
+                for template, capture_time, analysis_time, quality
+                in zip(_CAM_TEMPLATES, capture_times, analysis_times, qualities)
+            ],
             "defects": [],
             "statistics": {
                 "totalInspections": self.inspection_count,
@@ -130,51 +249,37 @@ class VisionInspectionStation:
             }
         }
         
-        # Add camera results
-        for cam in CAMERAS:
-            cam_result = {
-                "cameraId": cam["id"],
-                "position": cam["position"],
-                "captureTimeMs": random.randint(15, 30),
-                "analysisTimeMs": random.randint(30, 60),
-                "imageQuality": round(random.uniform(0.95, 1.0), 3)
-            }
-            result["cameras"].append(cam_result)
-        
         if passed:
             self.pass_count += 1
             result["inspection"]["defectType"] = "None"
         else:
             self.fail_count += 1
-            defect_type = self._select_defect_type()
+            defect_type = self._select_defect_type(defect_draw)
             self.defect_counts[defect_type] += 1
             result["inspection"]["defectType"] = defect_type
             
             defect_detail = {
                 "type": defect_type,
-                "severity": random.choice(["Minor", "Major", "Critical"]),
+                "severity": SEVERITIES[severity_index],
                 "location": {
-                    "x": random.randint(100, 900),
-                    "y": random.randint(100, 900),
-                    "width": random.randint(10, 100),
-                    "height": random.randint(10, 100)
+                    "x": x,
+                    "y": y,
+                    "width": width,
+                    "height": height
                 },
-                "detectedBy": random.choice([c["id"] for c in CAMERAS]),
-                "confidence": round(random.uniform(0.85, 0.98), 3)
+                "detectedBy": _CAM_IDS[camera_index],
+                "confidence": round(defect_confidence, 3)
             }
             result["defects"].append(defect_detail)
         
-        result["statistics"]["defectDistribution"] = dict(self.defect_counts)
+        # Shared, not copied: main() encodes the result before the next inspection mutates the counts
+        result["statistics"]["defectDistribution"] = self.defect_counts
         return result
     
-    def _select_defect_type(self) -> str:
-        r = random.random()
-        cumulative = 0
-        for defect, prob in DEFECT_TYPES.items():
-            cumulative += prob
-            if r <= cumulative:
-                return defect
-        return list(DEFECT_TYPES.keys())[0]
+    def _select_defect_type(self, r: float) -> str:
+        # First defect whose cumulative probability reaches r; falls back to the first if the sums fall short
+        i = bisect.bisect_left(_DEFECT_CUM, r)
+        return _DEFECT_NAMES[i] if i < len(_DEFECT_NAMES) else _DEFECT_NAMES[0]
 
 
 async def main():
@@ -215,11 +320,11 @@ async def main():
                    f"{result['inspection']['partSerial']} {defect_info} | "
                    f"Rate: {result['statistics']['passRate']:.1f}%")
             
-            log_json("INFO", msg, "Inspection")
+            log_inspection(msg)
             
             if iot_client:
                 try:
-                    message = Message(json.dumps(result))
+                    message = Message(_dumps(result))
                     message.content_type = "application/json"
                     message.content_encoding = "utf-8"
                     message.custom_properties["dataType"] = "vision_inspection"
@@ -229,6 +334,7 @@ async def main():
                     log_json("ERROR", f"Send failed: {e}", "IoTHub")
             
             wait_time = INSPECTION_INTERVAL + random.uniform(-0.5, 0.5)
+            _OUT.flush()
             await asyncio.sleep(max(1, wait_time))
             
     except KeyboardInterrupt: